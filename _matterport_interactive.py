@@ -165,28 +165,35 @@ def parse_command(answer):
     return None, answer
 
 
-def download(matterportArgs, url):
+def download(matterportArgs, inputs):
     headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"}
 
-    if "https://" in url:
-        result = requests.get(url, headers=headers)
-        content = result.content.decode()
-        urls = set(re.findall(r"https://my\.matterport\.com/show/\?m=([a-zA-Z0-9]+)", content))
-        # TODO: support more website types?: https://my.matterport.com/models/EGxFGTFyC9N
-        # https://my.matterport.com/work?m=EGxFGTFyC9N
-        # urls = set(re.findall(r'https://my\.matterport\.com/(show/|work)\?m=([a-zA-Z0-9]+)', content))
-        if len(urls) < 1:
-            download(input("no matterport was found! please enter a valid web address: "))
-            return
-    else:
-        urls = [url]
-
-    for url in urls:
-        fullArgs = [sys.executable] + matterportArgs + [url]
-        output = subprocess.run(fullArgs)
-        if output.returncode == 1:
-            print_colored('Download failed! Make sure you type in a valid web address or ID. The web address must contain "https://" Please consider that the downloader itself might be broken.', bcolors.FAIL)
-        print_separator()
+    urls = []
+    for url in inputs:
+        if not url:
+            continue
+        if "https://" in url:
+            result = requests.get(url, headers=headers)
+            content = result.content.decode()
+            found = set(re.findall(r"https://my\.matterport\.com/show/\?m=([a-zA-Z0-9]+)", content))
+            # TODO: support more website types?: https://my.matterport.com/models/EGxFGTFyC9N
+            # https://my.matterport.com/work?m=EGxFGTFyC9N
+            # urls = set(re.findall(r'https://my\.matterport\.com/(show/|work)\?m=([a-zA-Z0-9]+)', content))
+            if len(found) < 1:
+                download(matterportArgs, [input("no matterport was found! please enter a valid web address: ")])
+                continue
+            urls.extend(found)
+        else:
+            urls.append(url)
+    if not urls:
+        return
+
+    # more than one model goes as a single batch run so they share connections rather than starting a process each
+    fullArgs = [sys.executable] + matterportArgs + (urls if len(urls) == 1 else ["--batch", ",".join(urls)])
+    output = subprocess.run(fullArgs)
+    if output.returncode == 1:
+        print_colored('Download failed! Make sure you type in a valid web address or ID. The web address must contain "https://" Please consider that the downloader itself might be broken.', bcolors.FAIL)
+    print_separator()
 
 
 def getModelId(input_text, keys, downloads):
@@ -299,8 +306,7 @@ def interactiveManagerGetToServe(downloadDir, matterportArgs):
                 error_message("failed to rename matterport")
 
         elif command == "download":
-            for url in arg.split(" "):
-                download(matterportArgs, url)
+            download(matterportArgs, arg.split(" "))
         else:  # assume user wants to start/serve it so just make sure it exists
             model_id = getModelId(arg, keys, downloads)
             if not model_id:
@@ -8,7 +8,8 @@ Usage is either running this program with the URL/pageid as an argument or calli
 
 from __future__ import annotations
 import urllib.parse
-from curl_cffi import requests
+from curl_cffi import requests, CurlECode, CurlHttpVersion, CurlOpt
+from curl_cffi.curl import CURL_WRITEFUNC_ERROR
 from enum import Enum
 import asyncio
 import aiofiles
@@ -20,11 +21,17 @@ import pathlib
 import re
 import os
 import hashlib
+import email.utils
+import random
 import platform
 
 import shutil
+import sqlite3
+import struct
 import sys
+import time
 from typing import Any, ClassVar, cast
+from collections.abc import Awaitable, Callable, Iterable, Iterator
 from dataclasses import dataclass
 
 import logging
@@ -32,7 +39,7 @@ from functools import partial
 from tqdm import tqdm as std_tqdm
 
 tqdm = partial(std_tqdm, smoothing=0.1)
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import HTTPServer, SimpleHTTPRequestHandler, ThreadingHTTPServer
 import decimal
 import signal
 
@@ -44,8 +51,46 @@ if sys.platform == "win32":
 
 BASE_MATTERPORTDL_DIR = pathlib.Path(__file__).resolve().parent
 SCRIPT_NAME = os.path.basename(sys.argv[0])
-MAX_CONCURRENT_REQUESTS = 20  # cffi will make sure no more than this many curl workers are used at once
+MAX_CONCURRENT_REQUESTS = 20  # starting limit on in-flight requests per host, adaptive concurrency moves it between ADAPTIVE_MIN_REQUESTS and ADAPTIVE_MAX_REQUESTS
 MAX_CONCURRENT_TASKS = 64  # while we could theoretically leave this unbound just relying on MAX_CONCURRENT_REQESTS there is little reason to spawn a million tasks at once
+MAX_QUEUED_DOWNLOADS = MAX_CONCURRENT_TASKS * 4  # how far the producer can get ahead of the download workers before it has to wait
+PARTIAL_DOWNLOAD_SUFFIX = ".partial"  # in progress downloads are written here and renamed into place once complete
+PARTIAL_VALIDATOR_SUFFIX = f".range{PARTIAL_DOWNLOAD_SUFFIX}"  # the ETag/Last-Modified the partial was downloaded against, sent as If-Range when resuming it
+SERIES_PROBE_FANOUT = 8  # concurrent probes per round when narrowing down how many items a numbered texture series has
+MANIFEST_FILENAME = "download_manifest.sqlite"
+MANIFEST_COMMIT_EVERY = 500  # manifest rows written between sqlite commits
+ASSET_CACHE_INDEX_FILENAME = "index.sqlite"
+SYNC_BASE_DIR = "sync_base"  # --sync keeps the graph data it diffs against here until the run completes
+SYNC_REPORT_FILENAME = "sync_report.json"
+PLAN_FILENAME = "download_plan.json"
+PLAN_SAMPLES_PER_TYPE = 8  # files of each download type probed for size when planning, the rest of the type is estimated from them
+PLAN_PROBE_TYPES = {"UUID_TEXTURE_HIGH", "ADV_TEXTURE_FULL", "MODEL_SWEEPS_TIER_PROBE"}  # numbered series and the per sweep 2k/4k tier probes, always probed when planning as we only know what exists by trying
+PLAN_FETCH_TYPES = {"MODEL_INFO"}  # small metadata later phases read back off disk, fetched for real when planning
+PLAN_DISK_MARGIN = 1.1  # free space wanted over the plan's estimate
+SYNC_GRAPH_QUERIES = ["GetModelDetails", "GetSnapshots", "GetShowcaseSweeps", "GetModelViewPrefetch"]  # the graph data that lists the model's assets
+ASSET_CACHE_TYPES = {"STATIC_ASSET", "HTML_DISCOVERED_JS", "SHOWCASE_DISCOVERED_JS", "SHOWCASE_DISCOVERED_CSS", "STATIC_IMAGE", "STATIC_FONT", "STATIC_LOCAL_STRINGS", "WEBGL_FILE"}  # download types that come from versioned static urls so are the same for every model using that showcase version
+ADAPTIVE_MIN_REQUESTS = 2
+ADAPTIVE_MAX_REQUESTS = MAX_CONCURRENT_TASKS  # can never have more than one request per task anyway
+RATE_LIMIT_BURST_SECONDS = 0.25  # how much unused rate a token bucket can save up, small so we stay smooth rather than bursting after an idle moment
+THIRD_PARTY_MAX_REQUESTS = 4  # non matterport hosts (attachments etc) are usually small servers, no reason for them to hold more curl handles than this
+ADAPTIVE_DECREASE_FACTOR = 0.5
+ADAPTIVE_DECREASE_COOLDOWN = 2.0  # seconds, a burst of errors from one overload should only cut the limit once
+ADAPTIVE_LATENCY_TOLERANCE = 2.0  # only grow while the smoothed time to headers is within this multiple of the best we have seen
+ADAPTIVE_LATENCY_SMOOTHING = 0.1
+RETRY_AFTER_MAX = 120.0  # seconds, cap on how long we will honor a Retry-After header
+RESUME_MIN_BYTES = 256 * 1024  # failed downloads with less than this on disk are thrown away rather than kept to resume with a Range request
+
+KEY_ROUTE_MAX_ATTEMPTS = 3  # keys a request tries on 403 once its url pattern has a known working key
+KEY_ROUTE_CANARY_MAX_ATTEMPTS = 8  # keys the first (canary) request for a url pattern tries before we give up on finding one
+KEY_REFRESH_INTERVAL = 30 * 60  # seconds, refetch the key bearing files in the background once our keys are this old
+KEY_REFRESH_FAILURES = 5  # or once this many requests got a 403 with one of our typed keys
+KEY_REFRESH_MIN_INTERVAL = 60  # seconds between refreshes however many 403s we see
+LAZY_SERVE_TIMEOUT = 120  # seconds a --lazy-serve request waits on fetching a missing file before giving up with a 404
+KEY_SEARCH_ENOUGH_KEYS = 3  # --find-url-key stops probing once this many keys work unless --find-url-key-exhaustive
+
+RE_HTTP_ERROR_STATUS = re.compile(r"HTTP Error (\d{3})")
+RE_KEY_ROUTE_ID_SEGMENT = re.compile(r"(?=.*\d)[0-9A-Za-z_-]{10,}")  # model/sweep id style path segments, collapsed so all urls for one kind of asset share a key route
+CONNECTION_ERROR_CURL_CODES = {CurlECode.COULDNT_CONNECT, CurlECode.OPERATION_TIMEDOUT, CurlECode.GOT_NOTHING, CurlECode.SEND_ERROR, CurlECode.RECV_ERROR, CurlECode.PARTIAL_FILE, CurlECode.SSL_CONNECT_ERROR, CurlECode.HTTP2, CurlECode.HTTP2_STREAM}
 
 BASE_MATTERPORT_DOMAIN = "matterport.com"
 CHINA_MATTERPORT_DOMAIN = "matterportvr.cn"
@@ -59,6 +104,10 @@ SERVED_BASE_URL: str  # url we are serving from ie http://127.0.0.1:8080
 MODEL_IS_DEFURNISHED = False  # defurnished models can be accessed directly but have some quarks eventually will add to initial dl
 BASE_MODEL_ID = ""  # normally this is the model id we are downloading unless defurnished
 SWEEP_DO_4K = True  # assume 4k  by default
+SWEEP_TILE_RESOLUTIONS = ["512", "1k", "2k", "4k"]  # in order, each tier has twice the tiles per face edge of the last
+SWEEP_TILE_ALWAYS_RESOLUTIONS = ["512", "1k"]  # every pano has these even if not listed in its resolutions
+DownloadPriority = Enum("DownloadPriority", ["FirstRender", "MeshDetail", "Tiles2k", "Tiles4k", "Extras"])  # in order, what the viewer needs to first render downloads right away and everything else is deferred to run by priority after it (see deferDownload)
+SWEEP_TILE_PRIORITY = {"2k": DownloadPriority.Tiles2k, "4k": DownloadPriority.Tiles4k}  # the always tiers are first render
 
 AccessKeyType = Enum("AccessKeyType", ["LeaveKeyAlone", "PrimaryKey", "MAIN_PAGE_GENERIC_KEY", "MAIN_PAGE_DAM_50K", "FILES2_BASE_URL_KEY", "FILES3_TEMPLATE_KEY", "SWEEP_KEY", "GRAPH_MODEL_VIEW_PREFETCH"])  # sweep key primarily used for defurnished, GRAPH_MODEL_VIEW_PREFETCH is only used for attachments
 
@@ -157,15 +206,11 @@ def getModifiedName(filename: str):
     return f"{basename}.modified.{ext}"
 
 
-def getVariants():
+def getVariants(resolutions: list[str]):
     variants = []
-    global SWEEP_DO_4K
-    # to be smart we should be using the GetShowcaseSweeps file and data.model.locations[4].pano.resolutions  to determine if we should be trying 2k or 4k
-    depths = ["512", "1k", "2k"]
-    if SWEEP_DO_4K:
-        depths.append("4k")
-    for depth in range(len(depths)):
-        z = depths[depth]
+    for depth, z in enumerate(SWEEP_TILE_RESOLUTIONS):  # the index in SWEEP_TILE_RESOLUTIONS is what determines how many tiles per face
+        if z not in resolutions:
+            continue
         for x in range(2**depth):
             for y in range(2**depth):
                 for face in range(6):
@@ -173,36 +218,167 @@ def getVariants():
     return variants
 
 
+# Ids of the location the showcase opens at.  The model image is a snapshot taken from it, failing that the first highlight reel photo's location is used.  The snapshot anchor has both the location id and its pano id so either can match.
+def getStartLocationIds() -> set[str]:
+    try:
+        with open(os.path.join(THIS_MODEL_ROOT_DIR, "api/mp/models/graph_GetModelViewPrefetch.json"), "r", encoding="UTF-8") as f:
+            model = json.loads(f.read())["data"]["model"]
+        photo = model.get("image")
+        if not photo or not photo.get("snapshotLocation"):
+            reel = (model.get("activeHighlightReel") or {}).get("reel") or []
+            if not reel:
+                return set()
+            with open(os.path.join(THIS_MODEL_ROOT_DIR, "api/mp/models/graph_GetSnapshots.json"), "r", encoding="UTF-8") as f:
+                photos = json.loads(f.read())["data"]["model"]["assets"]["photos"]
+            photo = next((photo for photo in photos if photo["id"] == reel[0]["asset"]["id"]), None)
+        anchor = ((photo or {}).get("snapshotLocation") or {}).get("anchor")
+        if not anchor:
+            return set()
+        return {anchor["id"], (anchor.get("pano") or {}).get("id")} - {None}
+    except Exception:
+        logging.exception("Unable to find the start location from the graph data, sweeps will be fetched in graph order")
+        return set()
+
+
+# Sweep uuids of the locations from the start location outwards (nearest first when the locations have positions) so the first panos a viewer sees are the first to land
+def getSweepsFromStart(locations: list[Any]) -> list[str]:
+    locations = [location for location in locations if location.get("pano") and location["pano"].get("sweepUuid")]
+    startIds = getStartLocationIds()
+    start = next((location for location in locations if location.get("id") in startIds or location["pano"].get("id") in startIds), None)
+    if start is None:
+        return [location["pano"]["sweepUuid"] for location in locations]
+    startPos = start.get("position")
+
+    def distance(location) -> float:
+        pos = location.get("position")
+        if not startPos or not pos:
+            return 0.0
+        return sum((pos[axis] - startPos[axis]) ** 2 for axis in "xyz")
+
+    return [location["pano"]["sweepUuid"] for location in sorted(locations, key=lambda location: (location is not start, distance(location)))]  # stable so without positions the rest keep graph order
+
+
+# Returns sweep uuid => the tile resolutions to fetch for it.  Uses the per location pano.resolutions from GetShowcaseSweeps so we only ask for tiers each pano actually has, only falling back to brute forcing every tier for the v1 sweeps list if the graph data is not there
+def getSweepTilePlan(fallbackSweeps: list[str]) -> dict[str, list[str]]:
+    plan: dict[str, list[str]] = {}
+    try:
+        with open(os.path.join(THIS_MODEL_ROOT_DIR, "api/mp/models/graph_GetShowcaseSweeps.json"), "r", encoding="UTF-8") as f:
+            graphModelSweepsJson = json.loads(f.read())
+        for location in graphModelSweepsJson["data"]["model"]["locations"]:
+            pano = location.get("pano")
+            if not pano or not pano.get("sweepUuid"):
+                continue
+            panoResolutions = pano.get("resolutions") or []
+            maxDepth = max(SWEEP_TILE_RESOLUTIONS.index(res) for res in SWEEP_TILE_RESOLUTIONS if res in SWEEP_TILE_ALWAYS_RESOLUTIONS or res in panoResolutions)  # a pano with 4k still has every lower tier
+            plan[pano["sweepUuid"]] = SWEEP_TILE_RESOLUTIONS[: maxDepth + 1]
+        plan = {sweep: plan[sweep] for sweep in getSweepsFromStart(graphModelSweepsJson["data"]["model"]["locations"]) if sweep in plan}
+    except Exception:
+        logging.exception("Unable to build sweep tile plan from graph GetShowcaseSweeps data, falling back to v1 sweeps list")
+        plan = {}
+
+    if plan:
+        consoleDebugLog(f"Sweep tile plan from GetShowcaseSweeps: {len(plan)} sweeps {sum(len(getVariants(res)) for res in plan.values())} tiles")
+        return plan
+    fallbackResolutions = SWEEP_TILE_RESOLUTIONS if SWEEP_DO_4K else SWEEP_TILE_RESOLUTIONS[:-1]
+    for sweep in fallbackSweeps:
+        plan[sweep] = fallbackResolutions
+    consoleDebugLog(f"Sweep tile plan from v1 sweeps: {len(plan)} sweeps trying resolutions: {fallbackResolutions}")
+    return plan
+
+
 async def downloadDAM(accessurl, uuid):
     # This should have already been downloaded during the ADV download
     damSrcFile = f"..{os.path.sep}{uuid}_50k.dam"
     await downloadFile("UUID_DAM50K", True, accessurl.format(filename=f"{uuid}_50k.dam"), f"..{os.path.sep}{uuid}_50k.dam", key_type=AccessKeyType.FILES3_TEMPLATE_KEY)
-    shutil.copy(damSrcFile, f"{uuid}_50k.dam")  # so the url here has the ~ in it but the primary dir is the parent sitl lwe will store it both places
-    cur_file = ""
-    try:
-        for i in range(1000):  # basically download until on first failure and assume that is all of them, maybe we should be going to on first 404 or osmething:)
-            cur_file = accessurl.format(filename=f"{uuid}_50k_texture_jpg_high/{uuid}_50k_{i:03d}.jpg")
-            await downloadFile("UUID_TEXTURE_HIGH", True, cur_file, f"{uuid}_50k_texture_jpg_high/{uuid}_50k_{i:03d}.jpg")
-            cur_file = accessurl.format(filename=f"{uuid}_50k_texture_jpg_low/{uuid}_50k_{i:03d}.jpg")
-            await downloadFile("UUID_TEXTURE_LOW", True, cur_file, f"{uuid}_50k_texture_jpg_low/{uuid}_50k_{i:03d}.jpg")
-    except Exception as ex:
-        logging.warning(f"Exception downloading file: {cur_file} of: {str(ex)}")
-        pass  # very lazy and bad way to only download required files
+    if DOWNLOAD_PLAN is None:
+        shutil.copy(damSrcFile, f"{uuid}_50k.dam")  # so the url here has the ~ in it but the primary dir is the parent sitl lwe will store it both places
+
+    def textureFile(quality: str, i: int):
+        return f"{uuid}_50k_texture_jpg_{quality}/{uuid}_50k_{i:03d}.jpg"
+
+    textureCount = await discoverSeriesCount(lambda i: downloadFile("UUID_TEXTURE_HIGH", False, accessurl.format(filename=textureFile("high", i)), textureFile("high", i)))
+    consoleDebugLog(f"Found {textureCount} 50k dam textures for {uuid}")
+    toDownload: list[AsyncDownloadItem] = []
+    for i in range(textureCount):
+        toDownload.append(AsyncDownloadItem("UUID_TEXTURE_HIGH", True, accessurl.format(filename=textureFile("high", i)), textureFile("high", i)))
+        toDownload.append(AsyncDownloadItem("UUID_TEXTURE_LOW", True, accessurl.format(filename=textureFile("low", i)), textureFile("low", i)))
+    await AsyncArrayDownload(toDownload)
 
 
-async def downloadSweeps(accessurl: str, sweeps: list[str]):
+# Numbered series like textures (000, 001, ...) don't tell us how many there are, we only know by trying.  probe(i) should download item i and raise if it doesn't exist.  Rather than fetching one at a time until the first failure we gallop (0, 1, 2, 4, 8, ...) until the first miss so an empty or short series costs only a miss or two, then narrow the gap between the last hit and first miss with SERIES_PROBE_FANOUT concurrent probes per round.  Every probe is a real download so nothing is wasted on hits.
+async def discoverSeriesCount(probe: Callable[[int], Awaitable[Any]], maxCount: int = 1000) -> int:
+    results: dict[int, bool] = {}
+
+    async def tryProbe(i: int):
+        try:
+            await probe(i)
+            results[i] = True
+        except Exception:  # noqa: BLE001 - any failure ends the series, downloadFile already logged it
+            results[i] = False
+
+    async def probeAll(indexes):
+        await asyncio.gather(*(tryProbe(i) for i in indexes if i not in results))
+
+    lo = -1  # highest index known to exist
+    hi = maxCount  # lowest index known not to exist
+    i = 0
+    while i < maxCount:
+        await tryProbe(i)
+        if not results[i]:
+            hi = i
+            break
+        lo = i
+        i = i * 2 if i else 1
+    while True:
+        for i in sorted(k for k in results if lo < k < hi):  # like the old serial loop the first miss ends the series even if something after it exists
+            if not results[i]:
+                hi = i
+                break
+            lo = i
+        if hi - lo <= 1:
+            return lo + 1
+        step = max(1, (hi - lo) // (SERIES_PROBE_FANOUT + 1))
+        await probeAll(range(lo + step, hi, step))
+
+
+async def downloadSweeps(accessurl: str, sweepPlan: dict[str, list[str]]):
     global MODEL_IS_DEFURNISHED
     # the sweep query at least has data.model.defurnishViews[0].model.id for others
     forceKey = AccessKeyType.PrimaryKey
     if MODEL_IS_DEFURNISHED:
         forceKey = AccessKeyType.SWEEP_KEY
+
+    def sweepTile(sweep: str, variant: str, type: str = "MODEL_SWEEPS", shouldExist: bool = True):
+        return AsyncDownloadItem(type, shouldExist, accessurl.format(filename=f"tiles/{sweep}/{variant}") + "&imageopt=1", f"tiles/{sweep}/{variant}", key_type=forceKey)
+
+    # For the tiers not every pano has we first fetch just the first tile of the tier (a real tile so nothing wasted) and only expand the tier once that probe did not 404. Saves the flood of 404s for sweeps that don't have 2k/4k.  The probes get their own type so a plan probes every one of them rather than them sharing the MODEL_SWEEPS sample budget.
+    async def downloadTier(res: str, sweeps: list[str]):
+        variants = getVariants([res])
+        probes = [sweepTile(sweep, variants[0], "MODEL_SWEEPS_TIER_PROBE", False) for sweep in sweeps]
+        await AsyncArrayDownload(probes)
+        toDownload: list[AsyncDownloadItem] = []
+        droppedTiers = 0
+        for sweep, probe in zip(sweeps, probes):
+            if probe.error is not None and "Error 404" in f"{probe.error}":
+                droppedTiers += 1
+                continue
+            toDownload.extend(sweepTile(sweep, variant) for variant in variants[1:])
+        consoleDebugLog(f"Sweep tile probes dropped the {res} tier for {droppedTiers} of {len(probes)} sweeps, {len(toDownload)} tiles left to fetch")
+        await AsyncArrayDownload(toDownload)
+
+    # The always present tiers are what the viewer first renders so they go out right away a tier at a time across every sweep (in start location order), the higher tiers are deferred until the rest of the first render assets are in
+    sweepPlan = {sweep.replace("-", ""): resolutions for sweep, resolutions in sweepPlan.items()}
     toDownload: list[AsyncDownloadItem] = []
-    for sweep in sweeps:
-        sweep = sweep.replace("-", "")
-        for variant in getVariants():  # so if we checked for 404s we could do this more effeciently but serializing it to do that would be slower than just a bunch of 404s
-            toDownload.append(AsyncDownloadItem("MODEL_SWEEPS", True, accessurl.format(filename=f"tiles/{sweep}/{variant}") + "&imageopt=1", f"tiles/{sweep}/{variant}", key_type=forceKey))
+    for res in SWEEP_TILE_ALWAYS_RESOLUTIONS:
+        variants = getVariants([res])
+        toDownload.extend(sweepTile(sweep, variant) for sweep, resolutions in sweepPlan.items() if res in resolutions for variant in variants)
     await AsyncArrayDownload(toDownload)
 
+    for res, priority in SWEEP_TILE_PRIORITY.items():
+        sweeps = [sweep for sweep, resolutions in sweepPlan.items() if res in resolutions]
+        if sweeps:
+            deferDownload(priority, f"{res} sweep tiles", partial(downloadTier, res, sweeps))
+
 
 # these 3 downwload with json posts were old functions for old graphql queries we dont need/use ducrrently
 async def downloadFileWithJSONPostAndGetText(type, shouldExist, url, file, post_json_str, descriptor, always_download=False):
@@ -231,11 +407,8 @@ async def downloadFileWithJSONPost(type, shouldExist, url, file, post_json_str,
 
     reqId = logUrlDownloadStart(type, file, url, descriptor, shouldExist, key_type=AccessKeyType.PrimaryKey)
     try:
-        resp: requests.Response = await OUR_SESSION.request(url=url, method="POST", headers={"Content-Type": "application/json"}, data=bytes(post_json_str, "utf-8"))
-        resp.raise_for_status()
+        await downloadResponseToFile("POST", url, file, headers={"Content-Type": "application/json"}, data=bytes(post_json_str, "utf-8"))
         # req.add_header('Content-Length', len(body_bytes))
-        async with aiofiles.open(file, "wb") as the_file:
-            await the_file.write(resp.content)
         logUrlDownloadFinish(type, file, url, descriptor, shouldExist, reqId)
     except Exception as ex:
         logUrlDownloadFinish(type, file, url, descriptor, shouldExist, reqId, ex)
@@ -262,6 +435,8 @@ async def downloadFileAndGetText(type, shouldExist, url, file, post_data=None, i
     if not CLA.getCommandLineArg(CommandLineArg.TILDE):
         file = file.replace("~", "_")
 
+    if DOWNLOAD_PLAN is not None and not os.path.exists(file):  # we are after the content so it can't just be planned
+        always_download = True
     await downloadFile(type, shouldExist, url, file, post_data, always_download, key_type)
     if not os.path.exists(file):
         return ""
@@ -275,58 +450,696 @@ async def downloadFileAndGetText(type, shouldExist, url, file, post_data=None, i
             return await f.read()
 
 
+# Writes the response body for url to file raising on any error status.  When streaming (the default) chunks are written as curl hands them to us and only up to STREAM_CHUNK_SIZE bytes are buffered before a write, so memory per request does not grow with the file size.  curl picks its own receive sizes, our chunk size just controls how much we coalesce before each disk write.
+# The body is written to a .partial sibling and only renamed over the real file once complete, so an interrupted run never leaves a truncated file that later runs would skip as already downloaded.  Large leftover partials from a previous run are resumed with a Range request.
+# With validators for an existing file the request is made conditional, on a 304 or a body identical to what we have the file is left untouched (mtime and all) and False is returned.  The validators are updated from the response.
+async def downloadResponseToFile(method: str, url: str, file: str, validators: FileValidators | None = None, **kwargs) -> bool:
+    global OUR_SESSION
+    chunkSize = int(CLA.getCommandLineArg(CommandLineArg.STREAM_CHUNK_SIZE) or 0)
+    partialFile = f"{file}{PARTIAL_DOWNLOAD_SUFFIX}"
+    rangeValidatorFile = f"{file}{PARTIAL_VALIDATOR_SUFFIX}"
+    resumeFrom = 0
+    rangeValidator = None
+    revalidate = validators is not None and os.path.exists(file)
+    if validators is not None and revalidate:
+        kwargs = {**kwargs, "headers": {**(kwargs.get("headers") or {}), **validators.GetConditionalHeaders()}}
+    elif method == "GET" and chunkSize > 0 and os.path.exists(partialFile):
+        rangeValidator = readPartialRangeValidator(rangeValidatorFile)
+        if rangeValidator:
+            resumeFrom = os.path.getsize(partialFile)
+        else:  # without something to send as If-Range we cannot tell if the partial is still the same resource, start over
+            removePartialDownload(partialFile)
+    hostController = getHostController(url)
+    await hostController.Acquire()
+    shaper = getTrafficShaper()
+    shaping = shaper.Enabled()
+    try:
+        maxRecvSpeed = await shaper.Begin(hostController.host) if shaping else 0
+    except BaseException:
+        await hostController.Release(None, None)
+        raise
+    if maxRecvSpeed > 0:
+        kwargs = {**kwargs, "max_recv_speed": maxRecvSpeed}
+    requestStart = time.monotonic()
+    latency: float | None = None  # time to response headers, the body time depends too much on file size to be useful
+    error: Exception | None = None
+    restart = False
+    changed = True
+    digest = hashlib.sha256()
+    try:
+        if chunkSize <= 0:  # old behavior buffer the entire response in memory
+            response: requests.Response = await OUR_SESSION.Get(url).request(method, url, **kwargs)
+            latency = time.monotonic() - requestStart
+            raiseForStatus(response)
+            if validators is not None:
+                validators.UpdateFromHeaders(response.headers, response.status_code == 304)
+            if revalidate and response.status_code == 304:
+                return False
+            if shaping:
+                shaper.Charge(hostController.host, len(response.content))
+            if validators is not None:
+                digest.update(response.content)
+            async with aiofiles.open(partialFile, "wb") as f:
+                await f.write(response.content)
+        else:
+            requestArgs = dict(kwargs)
+            if resumeFrom > 0:
+                requestArgs["headers"] = {**(kwargs.get("headers") or {}), "Range": f"bytes={resumeFrom}-", "If-Range": rangeValidator}
+            async with OUR_SESSION.Get(url).stream(method, url, **requestArgs) as response:
+                latency = time.monotonic() - requestStart
+                if resumeFrom > 0 and response.status_code == 416:  # range not satisfiable, what we have does not line up with the resource any more
+                    raise PartialDownloadStale(f"Server rejected resuming {file} from byte {resumeFrom}")
+                raiseForStatus(response)
+                if validators is not None:
+                    validators.UpdateFromHeaders(response.headers, response.status_code == 304)
+                if revalidate and response.status_code == 304:
+                    return False
+                mode = "wb"
+                if resumeFrom > 0 and response.status_code == 206:
+                    if not response.headers.get("Content-Range", "").startswith(f"bytes {resumeFrom}-"):
+                        raise PartialDownloadStale(f"Server resumed {file} at a different offset than we asked for: {response.headers.get('Content-Range')}")
+                    mode = "ab"
+                    logging.debug(f"Resuming download of {file} from byte {resumeFrom}")
+                    if validators is not None:  # the sha256 we keep has to cover the whole file not just the part we are appending
+                        hashFile(partialFile, digest)
+                else:
+                    if resumeFrom > 0:  # If-Range did not match so the server sent the whole (changed) resource, what we had is truncated away
+                        logging.debug(f"Server sent all of {file} rather than resuming from byte {resumeFrom}, starting it over")
+                    writePartialRangeValidator(rangeValidatorFile, response.headers)
+                async with aiofiles.open(partialFile, mode) as f:
+                    buffer = bytearray()
+                    async for chunk in response.aiter_content():
+                        if shaping:
+                            shaper.Charge(hostController.host, len(chunk))
+                        if validators is not None:
+                            digest.update(chunk)
+                        buffer += chunk
+                        if len(buffer) >= chunkSize:
+                            await f.write(buffer)
+                            buffer.clear()
+                    if buffer:
+                        await f.write(buffer)
+        if validators is not None:
+            # a missing hash is a file downloaded before we kept validators, and a stored hash saying the file changed is only trusted once checked against the file as it may be from a resume that hashed just the tail
+            if revalidate and validators.sha256 != digest.hexdigest():
+                validators.sha256 = getFileSha256(file)
+            changed = not revalidate or validators.sha256 != digest.hexdigest()
+            validators.sha256 = digest.hexdigest()
+        if changed:
+            os.replace(partialFile, file)
+        else:  # same bytes as we already have, keep the old file so whatever was generated from it stays current
+            os.remove(partialFile)
+        if os.path.exists(rangeValidatorFile):
+            os.remove(rangeValidatorFile)
+    except PartialDownloadStale as ex:
+        logging.warning(f"{ex}, starting it over")
+        removePartialDownload(partialFile)
+        restart = True
+    except Exception as ex:
+        error = ex
+        # keep big partials around so the next run can resume them, anything else is not worth the Range request
+        if os.path.exists(partialFile) and (chunkSize <= 0 or method != "GET" or os.path.getsize(partialFile) < RESUME_MIN_BYTES):
+            removePartialDownload(partialFile)
+        raise
+    finally:
+        if shaping:
+            shaper.End(hostController.host)
+        await hostController.Release(latency, error)
+    if restart:  # outside the try so we are not holding our host slot while waiting on another
+        return await downloadResponseToFile(method, url, file, validators, **kwargs)
+    return changed
+
+
+class PartialDownloadStale(Exception):
+    pass
+
+
+# If-Range only accepts a strong ETag or a Last-Modified date, a weak ETag would make the server always send the whole file
+def writePartialRangeValidator(rangeValidatorFile: str, headers):
+    etag = headers.get("ETag")
+    validator = etag if etag and not etag.startswith("W/") else headers.get("Last-Modified")
+    if validator:
+        with open(rangeValidatorFile, "w", encoding="UTF-8") as f:
+            f.write(validator)
+    elif os.path.exists(rangeValidatorFile):
+        os.remove(rangeValidatorFile)
+
+
+def readPartialRangeValidator(rangeValidatorFile: str) -> str | None:
+    try:
+        with open(rangeValidatorFile, encoding="UTF-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def removePartialDownload(partialFile: str):
+    for path in (partialFile, partialFile.removesuffix(PARTIAL_DOWNLOAD_SUFFIX) + PARTIAL_VALIDATOR_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class HttpStatusError(Exception):
+    # same message as curl_cffi's raise_for_status so the "Error 404" style checks keep working, but keeps the status and any Retry-After
+    def __init__(self, response: requests.Response):
+        super().__init__(f"HTTP Error {response.status_code}: {response.reason}")
+        self.status = response.status_code
+        self.retryAfter = parseRetryAfter(response.headers.get("Retry-After"))
+
+
+def raiseForStatus(response: requests.Response):
+    if not response.ok:
+        raise HttpStatusError(response)
+
+
+# Retry-After is either a number of seconds or an http date
+def parseRetryAfter(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass
+class FileValidators:
+    etag: str | None = None
+    lastModified: str | None = None
+    sha256: str | None = None
+
+    def GetConditionalHeaders(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified:
+            headers["If-Modified-Since"] = self.lastModified
+        return headers
+
+    # a 304 can leave out validators that still hold, a full response carries exactly the ones for the bytes we got so old ones are not kept around
+    def UpdateFromHeaders(self, headers, notModified: bool = False):
+        if notModified:
+            self.etag = headers.get("ETag") or self.etag
+            self.lastModified = headers.get("Last-Modified") or self.lastModified
+        else:
+            self.etag = headers.get("ETag")
+            self.lastModified = headers.get("Last-Modified")
+
+
+def getFileSha256(file: str) -> str:
+    return hashFile(file, hashlib.sha256()).hexdigest()
+
+
+def hashFile(file: str, digest):
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest
+
+
+# One byte Range request for url returning the response (None on a connection error), the body write is aborted after the first chunk so we never pull a big file even if the Range is ignored
+async def probeUrl(url: str) -> requests.Response | None:
+    hostController = getHostController(url)
+    await hostController.Acquire()
+    requestStart = time.monotonic()
+    latency: float | None = None
+    error: Exception | None = None
+    try:
+        try:
+            response = await OUR_SESSION.Get(url).request("GET", url, headers={"Range": "bytes=0-0"}, content_callback=lambda chunk: CURL_WRITEFUNC_ERROR)
+        except requests.RequestsError as ex:
+            if ex.code != CurlECode.WRITE_ERROR or ex.response is None:  # WRITE_ERROR is just us dropping the body
+                raise
+            response = ex.response
+        latency = time.monotonic() - requestStart
+        logging.debug(f"Probe {response.status_code} for {url}")
+        return response
+    except Exception as ex:  # noqa: BLE001 - a probe that errors just leaves the file unsized in the plan
+        error = ex
+        logging.debug(f"Probe error for {url}: {ex}")
+        return None
+    finally:
+        await hostController.Release(latency, error)
+
+
+async def probeUrlWorks(url: str) -> bool:
+    response = await probeUrl(url)
+    return response is not None and response.status_code in (200, 206)
+
+
+# full size of the resource from a probeUrl response, None if the server didn't say
+# only a 2xx/3xx says the file is there, a 403 or a failed request says nothing either way
+def isProbePresent(response: requests.Response | None) -> bool:
+    return response is not None and response.status_code < 400
+
+
+def getProbedSize(response: requests.Response) -> int | None:
+    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+    if response.status_code == 206 and total.isdigit():
+        return int(total)
+    length = response.headers.get("Content-Length", "")
+    if response.status_code == 200 and length.isdigit():  # Range ignored
+        return int(length)
+    return None
+
+
+def getHttpErrorStatus(error: BaseException) -> int | None:
+    match = RE_HTTP_ERROR_STATUS.search(f"{error}")
+    return int(match.group(1)) if match else None
+
+
+def isConnectionError(error: BaseException):
+    return getattr(error, "code", None) in CONNECTION_ERROR_CURL_CODES
+
+
+# errors that suggest we are pushing a host too hard rather than the resource just being missing, so they are both retried and back off adaptive concurrency.  403 is left out, on matterport's CDN it is an expired or wrong access key.
+def isRetryableError(error: BaseException):
+    status = getHttpErrorStatus(error)
+    return status in (408, 429) or (status is not None and status >= 500) or isConnectionError(error)
+
+
+@dataclass
+class RetryPolicy:
+    retries: int
+    baseDelay: float = 1.0
+    maxDelay: float = 30.0
+
+    def GetDelay(self, attempt: int, retryAfter: float | None):
+        if retryAfter is not None:
+            return min(retryAfter, RETRY_AFTER_MAX)
+        return random.uniform(0.5, 1.0) * min(self.maxDelay, self.baseDelay * 2**attempt)  # jitter so a burst of failures doesn't all come back at once
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy(retries=3)
+RETRY_POLICIES: dict[str, RetryPolicy] = {  # by download type, the key bearing files everything else depends on get more chances
+    "MAIN": RetryPolicy(retries=5),
+    "GRAPH_MODEL": RetryPolicy(retries=5),
+    "MODEL_INFO": RetryPolicy(retries=5),
+    "FILE_TO_URL_JSON": RetryPolicy(retries=5),
+    "ADV_TEXTURE_CROPPED": RetryPolicy(retries=1),  # many of these are expected not to exist
+    "ADV_TILESET_EXTRACT": RetryPolicy(retries=1),
+    "FindUrlKey": RetryPolicy(retries=0),
+}
+
+
+# Retries transient failures (408/429/5xx, timeouts and connection errors) per the RetryPolicy for the download type with exponential backoff and jitter, honoring Retry-After.  404s and anything else are raised straight away.
+async def downloadResponseToFileWithRetries(type: str, url: str, file: str, shouldExist: bool, reqId, validators: FileValidators | None = None) -> bool:
+    policy = RETRY_POLICIES.get(type, DEFAULT_RETRY_POLICY)
+    attempt = 0
+    while True:
+        try:
+            return await downloadResponseToFile("GET", url, file, validators)
+        except Exception as err:
+            if attempt >= policy.retries or not isRetryableError(err):
+                raise
+            delay = policy.GetDelay(attempt, getattr(err, "retryAfter", None))
+            attempt += 1
+            PROGRESS.Increment(ProgressType.Retried)
+            logUrlDownloadFinish(type, file, url, f"retry {attempt}/{policy.retries} in {delay:.1f}s", shouldExist, reqId, err, True)
+            await asyncio.sleep(delay)
+
+
+class HostConcurrencyController:
+    """AIMD limit on in-flight requests to one host.  Starts at MAX_CONCURRENT_REQUESTS, adds one each time a limit's worth of requests complete with healthy latency while we are actually using the full limit, and halves (at most once per ADAPTIVE_DECREASE_COOLDOWN) on 408/429/5xx, timeouts and connection errors.  With adaptive concurrency disabled the limit just stays fixed."""
+
+    def __init__(self, host: str, adaptive: bool, maxLimit: int):
+        self.host = host
+        self.adaptive = adaptive
+        self.maxLimit = maxLimit
+        self.limit = min(MAX_CONCURRENT_REQUESTS, maxLimit)
+        self.inFlight = 0
+        self.available = asyncio.Condition()
+        self.latencyAvg: float | None = None
+        self.bestLatencyAvg: float | None = None
+        self.healthyCount = 0
+        self.lastDecrease = 0.0
+        self.increases = 0
+        self.decreases = 0
+
+    async def Acquire(self):
+        async with self.available:
+            await self.available.wait_for(lambda: self.inFlight < self.limit)
+            self.inFlight += 1
+
+    async def Release(self, latency: float | None, error: Exception | None):
+        async with self.available:
+            wasSaturated = self.inFlight >= self.limit
+            self.inFlight -= 1
+            if self.adaptive:
+                self._adjust(latency, error, wasSaturated)
+            self.available.notify(max(1, self.limit - self.inFlight))
+
+    def _adjust(self, latency: float | None, error: Exception | None, wasSaturated: bool):
+        if error is not None and isRetryableError(error):
+            now = time.monotonic()
+            if now - self.lastDecrease >= ADAPTIVE_DECREASE_COOLDOWN and self.limit > ADAPTIVE_MIN_REQUESTS:
+                oldLimit = self.limit
+                self.limit = max(ADAPTIVE_MIN_REQUESTS, int(self.limit * ADAPTIVE_DECREASE_FACTOR))
+                self.lastDecrease = now
+                self.healthyCount = 0
+                self.decreases += 1
+                logging.info(f"Adaptive concurrency {self.host}: decreasing limit {oldLimit} => {self.limit} after error: {error}")
+            return
+        if latency is None:
+            return
+        self.latencyAvg = latency if self.latencyAvg is None else self.latencyAvg * (1 - ADAPTIVE_LATENCY_SMOOTHING) + latency * ADAPTIVE_LATENCY_SMOOTHING
+        self.bestLatencyAvg = self.latencyAvg if self.bestLatencyAvg is None else min(self.bestLatencyAvg, self.latencyAvg)
+        if self.latencyAvg > self.bestLatencyAvg * ADAPTIVE_LATENCY_TOLERANCE:
+            self.healthyCount = 0
+            return
+        self.healthyCount += 1
+        if wasSaturated and self.healthyCount >= self.limit and self.limit < self.maxLimit:
+            self.limit += 1
+            self.healthyCount = 0
+            self.increases += 1
+            logging.info(f"Adaptive concurrency {self.host}: increasing limit to {self.limit} latency avg: {self.latencyAvg:.3f}s best: {self.bestLatencyAvg:.3f}s")
+
+    def __str__(self):
+        latencyStr = f"{self.latencyAvg:.3f}s" if self.latencyAvg is not None else "n/a"
+        return f"{self.host} limit: {self.limit} in flight: {self.inFlight} latency avg: {latencyStr} increases: {self.increases} decreases: {self.decreases}"
+
+
+HOST_CONTROLLERS: dict[str, HostConcurrencyController] = {}
+
+
+def getHostController(url: str) -> HostConcurrencyController:
+    host = urlparse(url).hostname or ""
+    if host not in HOST_CONTROLLERS:
+        HOST_CONTROLLERS[host] = HostConcurrencyController(host, CLA.getCommandLineArg(CommandLineArg.ADAPTIVE_CONCURRENCY), getHostMaxRequests(host))
+    return HOST_CONTROLLERS[host]
+
+
+def isMatterportHost(host: str):
+    return any(host == domain or host.endswith(f".{domain}") for domain in (BASE_MATTERPORT_DOMAIN, CHINA_MATTERPORT_DOMAIN))
+
+
+def getHostMaxRequests(host: str):
+    return ADAPTIVE_MAX_REQUESTS if isMatterportHost(host) else THIRD_PARTY_MAX_REQUESTS
+
+
+class HostSessionPool:
+    """One AsyncSession per host, each with its own curl handles and connection cache, so a slow attachment host can never tie up the handles the tile CDN needs and every request to a host lands on that host's warm connections.  Matterport hosts are asked for HTTP/2 (with PIPEWAIT so curl multiplexes new requests onto an open connection rather than racing a new handshake), other hosts keep curl's defaults."""
+
+    def __init__(self, **sessionArgs):
+        self.sessionArgs = sessionArgs
+        self.sessions: dict[str, requests.AsyncSession] = {}
+
+    def Get(self, url: str) -> requests.AsyncSession:
+        host = urlparse(url).hostname or ""
+        if host not in self.sessions:
+            args = dict(self.sessionArgs)
+            if isMatterportHost(host):
+                args.update(http_version=CurlHttpVersion.V2TLS, curl_options={CurlOpt.PIPEWAIT: 1})
+            self.sessions[host] = requests.AsyncSession(max_clients=getHostMaxRequests(host), **args)
+        return self.sessions[host]
+
+    async def Close(self):
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            await session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.Close()
+
+    def __str__(self):
+        return f"Session pool hosts: {', '.join(f'{host} ({session.max_clients})' for host, session in self.sessions.items())}"
+
+
+class TokenBucket:
+    """Refills at rate tokens a second holding at most RATE_LIMIT_BURST_SECONDS worth.  Take waits until the bucket is out of debt, Charge never waits, so bytes can be charged as they arrive and the debt a big response runs up is paid off by whoever starts the next request.  Waiters hold the lock while sleeping so they are released in order at the refill rate rather than all at once."""
+
+    def __init__(self, name: str, rate: float):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, rate * RATE_LIMIT_BURST_SECONDS)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.waited = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def Take(self, amount: float = 1):
+        async with self.lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens < 0:
+                delay = -self.tokens / self.rate
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+    def Charge(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def __str__(self):
+        return f"{self.name} rate: {self.rate:g}/s waited: {self.waited:.1f}s"
+
+
+class TrafficShaper:
+    """Global and per host limits on bytes and requests a second (MAX_BANDWIDTH, MAX_HOST_BANDWIDTH, MAX_REQUEST_RATE, MAX_HOST_REQUEST_RATE), 0 means no limit.  A request waits for its request tokens and for the byte buckets to be out of debt before starting, then its body is charged as it streams in.  curl reads ahead of us regardless of how fast we consume, so each transfer is also capped with max_recv_speed at its share of the tightest byte limit, keeping a few big files from blowing through the cap between request starts."""
+
+    def __init__(self, bandwidth: float, hostBandwidth: float, requestRate: float, hostRequestRate: float):
+        self.hostBandwidth = hostBandwidth
+        self.hostRequestRate = hostRequestRate
+        self.byteBucket = TokenBucket("bytes", bandwidth) if bandwidth > 0 else None
+        self.requestBucket = TokenBucket("requests", requestRate) if requestRate > 0 else None
+        self.hostByteBuckets: dict[str, TokenBucket] = {}
+        self.hostRequestBuckets: dict[str, TokenBucket] = {}
+        self.active = 0
+        self.hostActive: dict[str, int] = {}
+
+    def Enabled(self):
+        return self.byteBucket is not None or self.requestBucket is not None or self.hostBandwidth > 0 or self.hostRequestRate > 0
+
+    def _buckets(self, host: str) -> tuple[list[TokenBucket], list[TokenBucket]]:
+        byteBuckets = [self.byteBucket] if self.byteBucket is not None else []
+        requestBuckets = [self.requestBucket] if self.requestBucket is not None else []
+        if self.hostBandwidth > 0:
+            if host not in self.hostByteBuckets:
+                self.hostByteBuckets[host] = TokenBucket(f"{host} bytes", self.hostBandwidth)
+            byteBuckets.append(self.hostByteBuckets[host])
+        if self.hostRequestRate > 0:
+            if host not in self.hostRequestBuckets:
+                self.hostRequestBuckets[host] = TokenBucket(f"{host} requests", self.hostRequestRate)
+            requestBuckets.append(self.hostRequestBuckets[host])
+        return byteBuckets, requestBuckets
+
+    # waits until host may start another request returning the max_recv_speed (0 for unlimited) to give it
+    async def Begin(self, host: str) -> int:
+        byteBuckets, requestBuckets = self._buckets(host)
+        for bucket in requestBuckets:
+            await bucket.Take()
+        for bucket in byteBuckets:
+            await bucket.Take(0)
+        self.active += 1
+        self.hostActive[host] = self.hostActive.get(host, 0) + 1
+        shares = []
+        if self.byteBucket is not None:
+            shares.append(self.byteBucket.rate / self.active)
+        if self.hostBandwidth > 0:
+            shares.append(self.hostBandwidth / self.hostActive[host])
+        return max(1, int(min(shares))) if shares else 0
+
+    def Charge(self, host: str, amount: int):
+        for bucket in self._buckets(host)[0]:
+            bucket.Charge(amount)
+
+    def End(self, host: str):
+        self.active -= 1
+        self.hostActive[host] -= 1
+
+    def __str__(self):
+        buckets = [bucket for bucket in (self.byteBucket, self.requestBucket) if bucket is not None] + list(self.hostByteBuckets.values()) + list(self.hostRequestBuckets.values())
+        return f"Traffic shaping: {', '.join(str(bucket) for bucket in buckets) or 'no limits'}"
+
+
+TRAFFIC_SHAPER: TrafficShaper | None = None
+
+
+def getTrafficShaper() -> TrafficShaper:
+    # created on first use rather than in SetupSession so limits saved in the model's run_args.json apply
+    global TRAFFIC_SHAPER
+    if TRAFFIC_SHAPER is None:
+        TRAFFIC_SHAPER = TrafficShaper(*(float(CLA.getCommandLineArg(arg) or 0) for arg in (CommandLineArg.MAX_BANDWIDTH, CommandLineArg.MAX_HOST_BANDWIDTH, CommandLineArg.MAX_REQUEST_RATE, CommandLineArg.MAX_HOST_REQUEST_RATE)))
+    return TRAFFIC_SHAPER
+
+
+# where downloadFile will actually write file on disk
+def getLocalFile(file: str) -> str:
+    if not CLA.getCommandLineArg(CommandLineArg.TILDE):
+        file = file.replace("~", "_")
+    return file.split("?")[0]
+
+
 # Add type parameter, shortResourcePath, shouldExist
 async def downloadFile(type, shouldExist, url, file, post_data=None, always_download=False, key_type: AccessKeyType = AccessKeyType.PrimaryKey):
     global MAX_TASKS_SEMAPHORE, OUR_SESSION
     async with MAX_TASKS_SEMAPHORE:
         if key_type != AccessKeyType.LeaveKeyAlone:
+            KeyHandler.CheckRefresh()
             if key_type is None or key_type == AccessKeyType.PrimaryKey:
                 key = KeyHandler.PrimaryKey
             else:
                 key = KeyHandler.GetAccessKey(key_type)
             url = KeyHandler.SetAccessKeyForUrl(url, key)
 
-        if not CLA.getCommandLineArg(CommandLineArg.TILDE):
-            file = file.replace("~", "_")
-
+        file = getLocalFile(file)
+        if DOWNLOAD_PLAN is not None and not always_download and type not in PLAN_FETCH_TYPES:
+            await DOWNLOAD_PLAN.Add(type, url, file)
+            return
+        if not CLA.getCommandLineArg(CommandLineArg.DOWNLOAD) or (not always_download and isAlreadyDownloaded(file)):  # skip already downloaded files except always download ones which are genreally ones that may contain keys?
+            logUrlDownloadSkipped(type, file, url, "")
+            return
         if "/" in file:
             makeDirs(os.path.dirname(file))
-        if "?" in file:
-            file = file.split("?")[0]
-
-        if not CLA.getCommandLineArg(CommandLineArg.DOWNLOAD) or (os.path.exists(file) and not always_download):  # skip already downloaded files except always download ones which are genreally ones that may contain keys?
-            logUrlDownloadSkipped(type, file, url, "")
+        if MANIFEST is not None and not always_download and not CLA.getCommandLineArg(CommandLineArg.RETRY_MISSING) and MANIFEST.IsKnownMissing(file):
+            logUrlDownloadSkipped(type, file, url, "known missing from a previous run")
+            raise Exception(f"Request error for url: {url} ({type}) that would output to: {file} of: HTTP Error 404 recorded in the download manifest, use --retry-missing to request it again")  # callers probing for what exists need to see this the same as a real 404
+        if ASSET_CACHE is not None and type in ASSET_CACHE_TYPES and not always_download and ASSET_CACHE.Fetch(url, file):
+            PROGRESS.Increment(ProgressType.Cached)
+            _logUrlDownload(logging.DEBUG, "Linked from asset cache", type, file, url, "", shouldExist, "")
+            if FILE_INDEX is not None:
+                FILE_INDEX.Add(file)
+            if MANIFEST is not None:
+                MANIFEST.Record(file, url, type)
             return
+        validators = MANIFEST.GetValidators(file) if MANIFEST is not None and always_download else None  # always downloaded files are revalidated rather than taken again in full
         reqId = logUrlDownloadStart(type, file, url, "", shouldExist, key_type=key_type)
         try:
-            response = await OUR_SESSION.get(url)
-            response.raise_for_status()  # Raise an exception if the response has an error status code
-            async with aiofiles.open(file, "wb") as f:
-                await f.write(response.content)
-            logUrlDownloadFinish(type, file, url, "", shouldExist, reqId)
+            changed = True
+            if key_type != AccessKeyType.LeaveKeyAlone and KeyHandler.RE_ACCESS_KEY_EXTRACT.search(url):
+                url, changed = await downloadWithKeyRouting(type, url, file, shouldExist, reqId, validators)
+            else:
+                changed = await downloadResponseToFileWithRetries(type, url, file, shouldExist, reqId, validators)
+            if not changed:
+                PROGRESS.Increment(ProgressType.Unchanged)
+            logUrlDownloadFinish(type, file, url, "" if changed else "unchanged", shouldExist, reqId)
+            if FILE_INDEX is not None:
+                FILE_INDEX.Add(file)
+            if MANIFEST is not None:
+                MANIFEST.Record(file, url, type, validators=validators)
+            if ASSET_CACHE is not None and type in ASSET_CACHE_TYPES:
+                try:
+                    ASSET_CACHE.Store(url, file)
+                except Exception:
+                    logging.exception(f"Unable to add {file} to the asset cache")
             return
         except Exception as err:
-            # Try again but with different accesskeys, if error is 404 though no need to retry
-            if "?t=" in url and "Error 404" not in f"{err}":
-                if False:  # disable brute forcing at a minimum probably shouldnt do getallkeys just primary
-                    for key in KeyHandler.GetAllKeys():
-                        url2 = ""
-                        try:
-                            url2 = KeyHandler.SetAccessKeyForUrl(url, key)
-                            response = await OUR_SESSION.get(url2)
-                            response.raise_for_status()  # Raise an exception if the response has an error status code
-
-                            async with aiofiles.open(file, "wb") as f:
-                                await f.write(response.content)
-                            logUrlDownloadFinish(type, file, url2, "", shouldExist, reqId)
-                            return
-                        except Exception as err2:
-                            logUrlDownloadFinish(type, file, url2, "", shouldExist, reqId, err2, True)
-                            pass
             logUrlDownloadFinish(type, file, url, "", shouldExist, reqId, err)
+            if MANIFEST is not None:
+                MANIFEST.Record(file, url, type, err)
             raise Exception(f"Request error for url: {url} ({type}) that would output to: {file} of: {err}") from err
 
 
+# Downloads url trying the keys KeyHandler ranks for its url pattern, returning the url (with key) that worked and if the file changed (see downloadResponseToFile for validators).  The first request for a pattern is the canary: it works through up to KEY_ROUTE_CANARY_MAX_ATTEMPTS keys while every other request for that pattern waits, so a wrong key costs a few probes rather than a 403 per file.  After that requests start with the learned key and on a 403 re-key with up to KEY_ROUTE_MAX_ATTEMPTS keys, moving the route if another key works.
+async def downloadWithKeyRouting(type, url, file, shouldExist, reqId, validators: FileValidators | None = None) -> tuple[str, bool]:
+    pattern = KeyHandler.GetKeyRoutePattern(url)
+    while pattern not in KeyHandler.KEY_ROUTES and pattern in KeyHandler.KEY_ROUTE_CANARIES:
+        await KeyHandler.KEY_ROUTE_CANARIES[pattern].wait()
+    isCanary = pattern not in KeyHandler.KEY_ROUTES
+    if isCanary:
+        KeyHandler.KEY_ROUTE_CANARIES[pattern] = asyncio.Event()
+    try:
+        rankLater = not isCanary and pattern not in KeyHandler.KEY_ROUTE_EXHAUSTED  # most requests only need the learned route, the full ranking is only built once it gets a 403
+        candidates = [KeyHandler.KEY_ROUTES[pattern]] if rankLater else KeyHandler.GetRankedKeys(pattern, url, KEY_ROUTE_CANARY_MAX_ATTEMPTS if isCanary else KEY_ROUTE_MAX_ATTEMPTS)
+        i = 0
+        while i < len(candidates):
+            key = candidates[i]
+            keyUrl = KeyHandler.SetAccessKeyForUrl(url, key)
+            try:
+                changed = await downloadResponseToFileWithRetries(type, keyUrl, file, shouldExist, reqId, validators)
+                KeyHandler.RecordKeyResult(pattern, key, True)
+                return keyUrl, changed
+            except Exception as err:
+                status = getHttpErrorStatus(err)
+                if status != 403:
+                    if isCanary and status == 404:  # a 404 says nothing bad about the key, it got us past the auth check.  Connection errors, timeouts and 5xx say nothing good about it either.
+                        KeyHandler.RecordKeyResult(pattern, key, True)
+                    raise
+                KeyHandler.RecordKeyResult(pattern, key, False)
+                if rankLater:
+                    rankLater = False
+                    candidates = (candidates + [rankedKey for rankedKey in KeyHandler.GetRankedKeys(pattern, url, KEY_ROUTE_MAX_ATTEMPTS) if rankedKey not in candidates])[:KEY_ROUTE_MAX_ATTEMPTS]
+                if i == len(candidates) - 1:
+                    if isCanary:  # nothing works, stop probing for this pattern and let each request just fail with its own key
+                        KeyHandler.KEY_ROUTES[pattern] = candidates[0]
+                        KeyHandler.KEY_ROUTE_EXHAUSTED.add(pattern)
+                        logging.warning(f"No access key of {len(candidates)} tried works for {pattern}")
+                    raise
+                logUrlDownloadFinish(type, file, keyUrl, f"re-keying {i + 1}/{len(candidates)}", shouldExist, reqId, err, True)
+            i += 1
+        raise Exception(f"No access keys to try for {url}")
+    finally:
+        if isCanary:
+            KeyHandler.KEY_ROUTE_CANARIES.pop(pattern).set()
+
+
+# Refetches the files our typed keys come from (the main page prefetch data, files?type=3 and the graph view prefetch) and swaps any new keys in.  Runs as a background task started by KeyHandler.CheckRefresh so downloads keep going with the old keys meanwhile.
+async def refreshAccessKeys(pageid: str, reason: str):
+    consoleDebugLog(f"Refreshing access keys in the background, {reason}")
+    try:
+        newKeys: dict[AccessKeyType, str] = {}
+        base_page_text = await GetTextOnlyRequest("KEY_REFRESH", True, f"https://my.{BASE_MATTERPORT_DOMAIN}/show/?m={pageid}")
+        KeyHandler.SaveKeysFromText("RefreshMainBasePage", base_page_text)
+        preload_json = getPrefetchedModelData(base_page_text)
+        if preload_json is not None:
+            base_cache_node = preload_json["queries"]["GetModelPrefetch"]["data"]["model"]
+            if MODEL_IS_DEFURNISHED:
+                newKeys[AccessKeyType.SWEEP_KEY] = KeyHandler.GetKeysFromStr(base_cache_node["locations"][0]["pano"]["skyboxes"][0]["tileUrlTemplate"])[0]
+            else:
+                newKeys[AccessKeyType.MAIN_PAGE_GENERIC_KEY] = KeyHandler.GetKeysFromStr(base_cache_node["assets"]["textures"][0]["urlTemplate"])[0]
+                for mesh in base_cache_node["assets"]["meshes"]:
+                    if mesh["resolution"] == "50k":
+                        newKeys[AccessKeyType.MAIN_PAGE_DAM_50K] = KeyHandler.GetKeysFromStr(mesh["url"])[0]
+        if not MODEL_IS_DEFURNISHED:
+            file_type_content = await GetTextOnlyRequest("KEY_REFRESH", True, f"https://my.{BASE_MATTERPORT_DOMAIN}/api/player/models/{pageid}/files?type=3")
+            KeyHandler.SaveKeysFromText("RefreshFilesType3", file_type_content)
+            newKeys[AccessKeyType.FILES3_TEMPLATE_KEY] = KeyHandler.GetKeysFromStr(file_type_content)[0]
+            prefetch_text = await GetTextOnlyRequest("KEY_REFRESH", True, f"https://my.{BASE_MATTERPORT_DOMAIN}/api/mp/models/graph{GRAPH_DATA_REQ['GetModelViewPrefetch'].replace('[MATTERPORT_MODEL_ID]', pageid)}")
+            KeyHandler.SaveKeysFromText("RefreshGRAPH_GetModelViewPrefetch", prefetch_text)
+            prefetchKeys = KeyHandler.GetKeysFromStr(prefetch_text)
+            if len(prefetchKeys) > 0:
+                newKeys[AccessKeyType.GRAPH_MODEL_VIEW_PREFETCH] = prefetchKeys[0]
+        changed = [keyType for keyType, key in newKeys.items() if KeyHandler.ACCESS_KEYS_BY_TYPE.get(keyType) != key]
+        for keyType in changed:
+            KeyHandler.SetAccessKey(keyType, newKeys[keyType])
+        KeyHandler.KEY_ROUTE_EXHAUSTED.clear()  # patterns no key worked for get another canary with the new keys
+        KeyHandler.FailuresSinceRefresh = 0  # 403s while we were refreshing were most likely the old keys
+        consoleDebugLog(f"Access key refresh done, {len(changed)} of {len(newKeys)} keys changed")
+    except Exception:
+        logging.exception("Background access key refresh failed, will keep using the keys we have")
+
+
+MODIFIED_FILES_REUSABLE = False  # the .modified files on disk were generated by this same script with the same settings, see getModifiedFilesSignature
+
+
+# what the .modified files we generate depend on besides the files they are generated from
+def getModifiedFilesSignature():
+    try:
+        ourSha = self_sha()
+    except OSError:  # frozen builds may not have our source
+        ourSha = ""
+    return f"{ourSha}|{CLA.getCommandLineArg(CommandLineArg.MANUAL_HOST_REPLACEMENT)}|{CLA.getCommandLineArg(CommandLineArg.TILDE)}"
+
+
+# True if the .modified version of file from a previous run can be kept rather than generated again.  Downloads only replace a file when its content changed (always downloaded files are revalidated) so a .modified newer than its source is still current.
+def isModifiedFileCurrent(file: str):
+    modifiedFile = getModifiedName(file)
+    return MODIFIED_FILES_REUSABLE and os.path.exists(file) and os.path.exists(modifiedFile) and os.path.getmtime(modifiedFile) >= os.path.getmtime(file)
+
+
 def validUntilFix(text):
     return re.sub(r"validUntil\"\s*:\s*\"20[\d]{2}-[\d]{2}-[\d]{2}T", 'validUntil":"2099-01-01T', text)
 
@@ -339,13 +1152,15 @@ async def downloadGraphModels(pageid):
         file_path_base = f"api/mp/models/graph_{key}"
         file_path = f"{file_path_base}.json"
         req_url = GRAPH_DATA_REQ[key].replace("[MATTERPORT_MODEL_ID]", pageid)
-        text = await downloadFileAndGetText("GRAPH_MODEL", True, f"https://my.{BASE_MATTERPORT_DOMAIN}/api/mp/models/graph{req_url}", file_path, always_download=CLA.getCommandLineArg(CommandLineArg.REFRESH_KEY_FILES) and CLA.getCommandLineArg(CommandLineArg.ALWAYS_DOWNLOAD_GRAPH_REQS))
+        text = await downloadFileAndGetText("GRAPH_MODEL", True, f"https://my.{BASE_MATTERPORT_DOMAIN}/api/mp/models/graph{req_url}", file_path, always_download=(CLA.getCommandLineArg(CommandLineArg.REFRESH_KEY_FILES) and CLA.getCommandLineArg(CommandLineArg.ALWAYS_DOWNLOAD_GRAPH_REQS)) or CLA.getCommandLineArg(CommandLineArg.SYNC))
         KeyHandler.SaveKeysFromText(f"GRAPH_{key}", text)
         if key == "GetModelViewPrefetch" and not MODEL_IS_DEFURNISHED:
             prefetchKeys = KeyHandler.GetKeysFromStr(text)
             if len(prefetchKeys) > 0:
                 KeyHandler.SetAccessKey(AccessKeyType.GRAPH_MODEL_VIEW_PREFETCH, prefetchKeys[0])
 
+        if isModifiedFileCurrent(file_path):
+            continue
         # Patch (graph_GetModelDetails.json & graph_GetSnapshots.json and such) URLs to Get files form local server instead of https://cdn-2.matterport.com/
         if CLA.getCommandLineArg(CommandLineArg.MANUAL_HOST_REPLACEMENT):
             text = text.replace(f"https://cdn-2.{BASE_MATTERPORT_DOMAIN}", "http://127.0.0.1:8080")  # without the localhost it seems like it may try to do diff
@@ -356,7 +1171,123 @@ async def downloadGraphModels(pageid):
             await f.write(text)
 
 
-ProgressType = Enum("ProgressType", ["Request", "Success", "Skipped", "Failed404", "Failed403", "FailedUnknown"])
+@dataclass
+class SyncAsset:
+    kind: str
+    id: str
+    fingerprint: str  # the asset's url paths, these are versioned and unlike the full urls don't change with the access keys
+    prefixes: list[str]  # model relative paths its files are stored under
+
+    def Owns(self, path: str):
+        return any(path.startswith(prefix) for prefix in self.prefixes) or (self.kind == "sweep" and f"/tiles/{self.id}/" in f"/{path}")  # sweep tiles live under whatever models/ folder the access url has
+
+
+# model relative path downloadFile stores url under, for url templates just the part before the first placeholder
+def getSyncPath(url: str) -> str:
+    return os.path.normcase(getLocalFile(urlparse(url).path[1:].split("<")[0]))
+
+
+# The assets listed in the SYNC_GRAPH_QUERIES graph data keyed by kind:id
+def getSyncAssets(graphs: dict[str, Any]) -> dict[str, SyncAsset]:
+    assets: dict[str, SyncAsset] = {}
+
+    def add(kind: str, id: str, urls: Iterable[str | None]):
+        paths = sorted({getSyncPath(url) for url in urls if url})
+        assets[f"{kind}:{id}"] = SyncAsset(kind, id, "|".join(paths), paths)
+
+    def model(key: str) -> Any:
+        return ((graphs.get(key) or {}).get("data") or {}).get("model") or {}
+
+    for location in model("GetShowcaseSweeps").get("locations") or []:
+        pano = location.get("pano") or {}
+        if pano.get("sweepUuid"):
+            add("sweep", pano["sweepUuid"].replace("-", ""), (skybox.get("urlTemplate") for skybox in pano.get("skyboxes") or []))
+    for photo in (model("GetSnapshots").get("assets") or {}).get("photos") or []:
+        url = photo.get("url") or photo.get("presentationUrl")
+        if url:
+            add("photo", photo.get("id") or getSyncPath(url), [url])
+    details = model("GetModelDetails").get("assets") or {}
+    for mesh in details.get("meshes") or []:
+        add("mesh", mesh.get("id") or mesh.get("resolution") or getSyncPath(mesh["url"]), [mesh.get("url")])
+    for i, tileset in enumerate(details.get("tilesets") or []):
+        add("tileset", tileset.get("id") or f"{i}", [tileset.get("url"), tileset.get("urlTemplate")])
+    for texture in details.get("textures") or []:
+        add("texture", texture.get("id") or texture.get("quality") or getSyncPath(texture["urlTemplate"]), [texture.get("urlTemplate")])
+    for mattertag in model("GetModelViewPrefetch").get("mattertags") or []:
+        for attachment in mattertag.get("fileAttachments") or []:
+            if attachment.get("url"):
+                add("attachment", attachment.get("id") or getSyncPath(attachment["url"]), [attachment["url"]])
+    return assets
+
+
+def readJsonFile(file: str) -> Any:
+    try:
+        with open(file, "r", encoding="UTF-8") as f:
+            return json.loads(f.read())
+    except Exception:
+        logging.exception(f"Unable to read json from {file}")
+        return None
+
+
+# The graph data of the last completed run.  It is copied aside before this run replaces it and only dropped once a run completes, so a sync that gets interrupted still diffs against the right thing next time.  The copy is made in a temporary folder renamed into place so an interrupted copy is never taken as a base.
+def loadSyncBase() -> dict[str, Any]:
+    if not os.path.exists(SYNC_BASE_DIR):
+        tmpDir = f"{SYNC_BASE_DIR}{PARTIAL_DOWNLOAD_SUFFIX}"
+        shutil.rmtree(tmpDir, ignore_errors=True)
+        os.makedirs(tmpDir)
+        for key in SYNC_GRAPH_QUERIES:
+            if os.path.exists(f"api/mp/models/graph_{key}.json"):
+                shutil.copy2(f"api/mp/models/graph_{key}.json", os.path.join(tmpDir, f"graph_{key}.json"))
+        os.replace(tmpDir, SYNC_BASE_DIR)
+    return {key: readJsonFile(os.path.join(SYNC_BASE_DIR, f"graph_{key}.json")) for key in SYNC_GRAPH_QUERIES if os.path.exists(os.path.join(SYNC_BASE_DIR, f"graph_{key}.json"))}
+
+
+def removeModelFile(path: str):
+    file = os.path.join(THIS_MODEL_ROOT_DIR, path)
+    try:
+        os.remove(file)
+    except FileNotFoundError:
+        pass
+    if FILE_INDEX is not None:
+        FILE_INDEX.Remove(file)
+    if MANIFEST is not None:
+        MANIFEST.Forget(file)
+
+
+# --sync: diffs the freshly fetched graph data against the sync base so the rest of the run only fetches the delta.  Added assets download as normal as they are not on disk yet, files of changed assets that keep their paths are deleted so they are fetched again, and files only removed or changed assets used are orphans that --sync-prune deletes.  Writes SYNC_REPORT_FILENAME.
+def syncModelChanges(previousGraphs: dict[str, Any]):
+    currentGraphs = {key: readJsonFile(f"api/mp/models/graph_{key}.json") for key in SYNC_GRAPH_QUERIES}
+    oldAssets = getSyncAssets(previousGraphs)
+    newAssets = getSyncAssets(currentGraphs)
+    added = sorted(name for name in newAssets if name not in oldAssets)
+    removed = sorted(name for name in oldAssets if name not in newAssets)
+    changed = sorted(name for name in newAssets if name in oldAssets and newAssets[name].fingerprint != oldAssets[name].fingerprint)
+    staleAssets = [oldAssets[name] for name in removed + changed]
+    currentAssets = [newAssets[name] for name in added + changed]
+    unchangedAssets = [asset for name, asset in newAssets.items() if name in oldAssets and name not in changed]
+    refetch: list[str] = []
+    orphaned: list[str] = []
+    for path in sorted(FILE_INDEX.files if FILE_INDEX is not None else []):
+        if not any(asset.Owns(path) for asset in staleAssets) or any(asset.Owns(path) for asset in unchangedAssets):
+            continue
+        if any(asset.Owns(path) for asset in currentAssets):
+            refetch.append(path)  # still used but what is there is the old content
+        else:
+            orphaned.append(path)
+    prune = CLA.getCommandLineArg(CommandLineArg.SYNC_PRUNE)
+    for path in refetch + (orphaned if prune else []):
+        removeModelFile(path)
+
+    report = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "previous_graph_data": bool(previousGraphs), "added": added, "changed": changed, "removed": removed, "refetched_files": refetch, "orphaned_files": orphaned, "pruned": prune}
+    with open(SYNC_REPORT_FILENAME, "w", encoding="UTF-8") as f:
+        f.write(json.dumps(report, indent="\t"))
+    if not previousGraphs:
+        consoleLog(f"Sync: no graph data from a previous run to compare against, downloading all {len(added)} assets")
+    else:
+        consoleLog(f"Sync: {len(added)} added, {len(changed)} changed, {len(removed)} removed assets, {len(refetch)} files to fetch again, {len(orphaned)} orphaned files{' pruned' if prune else ''}, see {SYNC_REPORT_FILENAME}")
+
+
+ProgressType = Enum("ProgressType", ["Request", "Success", "Skipped", "Failed404", "Failed403", "FailedUnknown", "Retried", "Cached", "Unchanged"])
 
 
 class ProgressStats:
@@ -364,7 +1295,7 @@ class ProgressStats:
         relInfo = ""
         if self.relativeTo is not None:
             relInfo = "Relative "
-        return f"{relInfo}Total fetches: {self.TotalPosRequests()} {self.ValStr(ProgressType.Skipped)} actual {self.ValStr(ProgressType.Request)} {self.ValStr(ProgressType.Success)} {self.ValStr(ProgressType.Failed403)} {self.ValStr(ProgressType.Failed404)} {self.ValStr(ProgressType.FailedUnknown)}"
+        return f"{relInfo}Total fetches: {self.TotalPosRequests()} {self.ValStr(ProgressType.Skipped)} actual {self.ValStr(ProgressType.Request)} {self.ValStr(ProgressType.Success)} {self.ValStr(ProgressType.Failed403)} {self.ValStr(ProgressType.Failed404)} {self.ValStr(ProgressType.FailedUnknown)} {self.ValStr(ProgressType.Retried)} {self.ValStr(ProgressType.Cached)} {self.ValStr(ProgressType.Unchanged)}"
 
     def RelativeMark(self):
         self.relativeTo = dict(self.stats)
@@ -389,7 +1320,7 @@ class ProgressStats:
         return val
 
     def TotalPosRequests(self):
-        ret = self.Val(ProgressType.Request) + self.Val(ProgressType.Skipped)
+        ret = self.Val(ProgressType.Request) + self.Val(ProgressType.Skipped) + self.Val(ProgressType.Cached)
         if ret == 0:
             ret = 0.01  # avoid div by 0
         return ret
@@ -401,13 +1332,316 @@ class ProgressStats:
 
     def Increment(self, typ: ProgressType, amt: int = 1):
         with self.locks[typ]:
-            self.stats[typ] += 1
+            self.stats[typ] += amt
             return self.stats[typ]
 
 
 PROGRESS = ProgressStats()
 
 
+# file (relative to the current dir) as a / separated path relative to rootDir, None for temp files and such outside the model
+def getModelRelativePath(file: str, rootDir: str) -> str | None:
+    rel = os.path.relpath(os.path.abspath(file), rootDir)
+    if rel.startswith(".."):
+        return None
+    return rel.replace(os.path.sep, "/")
+
+
+class LocalFileIndex:
+    """Every file under the model root, built once with os.scandir at the start of a capture so "already downloaded" checks are a set lookup rather than a stat per file (which adds up on network storage for resumed 35k file models)."""
+
+    def __init__(self, rootDir: str):
+        self.rootDir = rootDir
+        self.files: set[str] = set()
+        dirs = [""]
+        while dirs:
+            relDir = dirs.pop()
+            try:
+                with os.scandir(os.path.join(rootDir, relDir)) as it:
+                    for entry in it:
+                        relPath = f"{relDir}/{entry.name}" if relDir else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(relPath)
+                        elif not entry.name.endswith(PARTIAL_DOWNLOAD_SUFFIX):
+                            self.files.add(os.path.normcase(relPath))
+            except OSError:
+                logging.exception(f"Unable to index directory {relDir} for already downloaded files")
+
+    def Contains(self, file: str):
+        key = getModelRelativePath(file, self.rootDir)
+        if key is None:
+            return os.path.exists(file)
+        return os.path.normcase(key) in self.files
+
+    def Add(self, file: str):
+        key = getModelRelativePath(file, self.rootDir)
+        if key is not None:
+            self.files.add(os.path.normcase(key))
+
+    def Remove(self, file: str):
+        key = getModelRelativePath(file, self.rootDir)
+        if key is not None:
+            self.files.discard(os.path.normcase(key))
+
+
+FILE_INDEX: LocalFileIndex | None = None
+
+
+# whether downloadFile would skip file as already downloaded
+def isAlreadyDownloaded(file: str):
+    if FILE_INDEX is not None:
+        return FILE_INDEX.Contains(file)
+    return os.path.exists(file)
+
+
+ManifestStatus = Enum("ManifestStatus", ["Ok", "Missing", "Failed"])
+
+
+class DownloadManifest:
+    """Per model sqlite record of every file we have tried to download (keyed by path relative to the model root) with its url, asset type, status, size, time and last error.  Resources that 404'd are kept in memory so re-runs can skip them without asking again.  Files we always re-download also keep their ETag, Last-Modified and sha256 so the next run can revalidate them rather than taking them again in full."""
+
+    def __init__(self, dbFile: str, rootDir: str):
+        self.rootDir = rootDir
+        self.db = sqlite3.connect(dbFile)
+        self.db.execute("CREATE TABLE IF NOT EXISTS downloads (path TEXT PRIMARY KEY, url TEXT, type TEXT, status TEXT, size INTEGER, updated REAL, error TEXT)")
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(downloads)")}
+        for column in ("etag", "last_modified", "sha256"):  # manifests from before we kept validators
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE downloads ADD COLUMN {column} TEXT")
+        self.db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        self.missing: set[str] = {row[0] for row in self.db.execute("SELECT path FROM downloads WHERE status = ?", (ManifestStatus.Missing.name,))}
+        self.uncommitted = 0
+
+    def _key(self, file: str) -> str | None:
+        return getModelRelativePath(file, self.rootDir)
+
+    def IsKnownMissing(self, file: str):
+        return self._key(file) in self.missing
+
+    def GetValidators(self, file: str) -> FileValidators:
+        row = self.db.execute("SELECT etag, last_modified, sha256 FROM downloads WHERE path = ? AND status = ?", (self._key(file), ManifestStatus.Ok.name)).fetchone()
+        return FileValidators(*row) if row else FileValidators()
+
+    def GetSetting(self, name: str) -> str | None:
+        row = self.db.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def SetSetting(self, name: str, value: str):
+        self.db.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)", (name, value))
+        self.db.commit()
+
+    def Record(self, file: str, url: str, type: str, error: Exception | None = None, validators: FileValidators | None = None):
+        key = self._key(file)
+        if key is None:
+            return
+        size = None
+        if error is None:
+            status = ManifestStatus.Ok
+            size = os.path.getsize(file) if os.path.exists(file) else None
+        elif "Error 404" in f"{error}":
+            status = ManifestStatus.Missing
+        else:
+            status = ManifestStatus.Failed  # 403s and such can be key problems so they are not treated as known missing
+        if status == ManifestStatus.Missing:
+            self.missing.add(key)
+        else:
+            self.missing.discard(key)
+        if validators is None:
+            validators = FileValidators()
+        self.db.execute("INSERT OR REPLACE INTO downloads (path, url, type, status, size, updated, error, etag, last_modified, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (key, url, type, status.name, size, time.time(), f"{error}" if error else None, validators.etag, validators.lastModified, validators.sha256))
+        self.uncommitted += 1
+        if self.uncommitted >= MANIFEST_COMMIT_EVERY:
+            self.Commit()
+
+    def Commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def Forget(self, file: str):
+        key = self._key(file)
+        if key is None:
+            return
+        self.missing.discard(key)
+        self.db.execute("DELETE FROM downloads WHERE path = ?", (key,))
+
+    def StatusCounts(self) -> dict[str, int]:
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM downloads GROUP BY status").fetchall())
+
+    def Close(self):
+        self.db.commit()
+        self.db.close()
+
+
+MANIFEST: DownloadManifest | None = None
+
+
+# hardlinks so the model folder and cache share one copy on disk, copies where the filesystem (or a cache on another drive) can't link
+def linkOrCopyFile(source: str, target: str):
+    tmpTarget = f"{target}{PARTIAL_DOWNLOAD_SUFFIX}"
+    if os.path.exists(tmpTarget):
+        os.remove(tmpTarget)
+    try:
+        os.link(source, tmpTarget)
+    except OSError:
+        shutil.copyfile(source, tmpTarget)
+    os.replace(tmpTarget, target)
+
+
+class SharedAssetCache:
+    """Content addressed store of static showcase assets shared by every model (--asset-cache).  Files live under objects/ named by their sha256 and index.sqlite maps each url to its hash, so a new capture of the same showcase version links them in without a request and identical files from different urls are stored once.  Only ASSET_CACHE_TYPES are cached as their urls are versioned, nothing keyed or model specific goes in here."""
+
+    def __init__(self, cacheDir: str):
+        self.cacheDir = cacheDir
+        os.makedirs(os.path.join(cacheDir, "objects"), exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cacheDir, ASSET_CACHE_INDEX_FILENAME), timeout=30)  # several runs may share a cache
+        self.db.execute("CREATE TABLE IF NOT EXISTS assets (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL, updated REAL)")
+        self.hits = 0
+        self.stored = 0
+
+    def _objectFile(self, digest: str):
+        return os.path.join(self.cacheDir, "objects", digest[:2], digest)
+
+    # links url's cached content to file returning False if we don't have it
+    def Fetch(self, url: str, file: str) -> bool:
+        row = self.db.execute("SELECT sha256, size FROM assets WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return False
+        objectFile = self._objectFile(row[0])
+        if not os.path.exists(objectFile) or os.path.getsize(objectFile) != row[1]:  # someone cleaned up the cache by hand
+            return False
+        linkOrCopyFile(objectFile, file)
+        self.hits += 1
+        return True
+
+    def Store(self, url: str, file: str):
+        digest = getFileSha256(file)
+        objectFile = self._objectFile(digest)
+        if not os.path.exists(objectFile):
+            os.makedirs(os.path.dirname(objectFile), exist_ok=True)
+            linkOrCopyFile(file, objectFile)
+        self.db.execute("INSERT OR REPLACE INTO assets (url, sha256, size, updated) VALUES (?, ?, ?, ?)", (url, digest, os.path.getsize(objectFile), time.time()))
+        self.db.commit()
+        self.stored += 1
+
+    def Close(self):
+        self.db.close()
+
+    def __str__(self):
+        return f"Asset cache {self.cacheDir} hits: {self.hits} stored: {self.stored}"
+
+
+ASSET_CACHE: SharedAssetCache | None = None
+
+
+def closeAssetCache():
+    global ASSET_CACHE
+    if ASSET_CACHE is not None:
+        consoleDebugLog(f"{ASSET_CACHE}")
+        ASSET_CACHE.Close()
+        ASSET_CACHE = None
+
+
+@dataclass
+class PlannedFile:
+    type: str
+    url: str
+    onDisk: bool
+    probe: asyncio.Task[requests.Response | None] | None = None
+
+
+class DownloadPlan:
+    """What a download run would fetch (--plan / --preflight).  While planning downloadFile records files here rather than fetching them, only metadata (graph data, model info and anything else read back for its content) is really downloaded.  The first PLAN_SAMPLES_PER_TYPE files of each type that are not on disk yet are probed with a one byte Range request for whether they exist and their size, the rest of the type is estimated from those samples."""
+
+    def __init__(self):
+        self.files: dict[str, PlannedFile] = {}
+        self.sampled: dict[str, int] = {}
+        self.fitsOnDisk = True
+
+    async def Add(self, type: str, url: str, file: str):
+        planned = self.files.get(file)
+        if planned is None:
+            if MANIFEST is not None and not CLA.getCommandLineArg(CommandLineArg.RETRY_MISSING) and MANIFEST.IsKnownMissing(file):
+                raise Exception(f"HTTP Error 404 recorded in the download manifest for {file}")
+            planned = PlannedFile(type, url, isAlreadyDownloaded(file))
+            self.files[file] = planned
+            if not planned.onDisk and (type in PLAN_PROBE_TYPES or self.sampled.get(type, 0) < PLAN_SAMPLES_PER_TYPE):
+                self.sampled[type] = self.sampled.get(type, 0) + 1
+                planned.probe = asyncio.create_task(probeUrl(url))
+        if planned.probe is not None:
+            response = await planned.probe
+            if response is None:
+                raise Exception(f"Probe of {url} failed")
+            if not isProbePresent(response):
+                raise HttpStatusError(response)  # anything probing for what exists (series counts, sweep tiers) needs to see this like the real request failing
+
+    # files AsyncArrayDownload dropped up front as already downloaded so they never reach downloadFile
+    def AddOnDisk(self, type: str, url: str, file: str):
+        if file not in self.files:
+            self.files[file] = PlannedFile(type, url, True)
+
+    def GetTypeEstimates(self) -> dict[str, dict[str, Any]]:
+        estimates: dict[str, dict[str, Any]] = {}
+        for planned in self.files.values():
+            est = estimates.setdefault(planned.type, {"files": 0, "on_disk": 0, "probed": 0, "probed_missing": 0, "probe_errors": 0, "sizes": []})
+            est["files"] += 1
+            if planned.onDisk:
+                est["on_disk"] += 1
+            elif planned.probe is not None and planned.probe.done():
+                response = planned.probe.result()
+                est["probed"] += 1
+                if response is not None and response.status_code == 404:
+                    est["probed_missing"] += 1
+                elif not isProbePresent(response):  # 403s, 5xx and connection errors don't tell us if the file exists
+                    est["probe_errors"] += 1
+                elif (size := getProbedSize(response)) is not None:
+                    est["sizes"].append(size)
+        for est in estimates.values():
+            toFetch = est["files"] - est["on_disk"]
+            unknown = toFetch - est["probed"] + est["probe_errors"]
+            found = est["probed"] - est["probed_missing"] - est["probe_errors"]
+            answered = found + est["probed_missing"]
+            existRatio = found / answered if answered else 1.0  # types that may not exist (crops, tileset extracts) are scaled by how many of the samples did
+            est["to_fetch"] = toFetch
+            est["estimated_files"] = round(found + unknown * existRatio)
+            sizes = est.pop("sizes")
+            est["estimated_bytes"] = round(sum(sizes) + (est["estimated_files"] - len(sizes)) * (sum(sizes) / len(sizes))) if sizes else (0 if est["estimated_files"] == 0 else None)
+        return estimates
+
+    # logs the plan, checks it against the free disk space and writes it to PLAN_FILENAME in the model folder
+    def Finish(self, pageid: str):
+        estimates = self.GetTypeEstimates()
+        estimatedBytes = sum(est["estimated_bytes"] or 0 for est in estimates.values())
+        freeBytes = shutil.disk_usage(THIS_MODEL_ROOT_DIR).free
+        self.fitsOnDisk = estimatedBytes * PLAN_DISK_MARGIN <= freeBytes
+        notes = []
+        if any(est["estimated_bytes"] is None and est["estimated_files"] for est in estimates.values()):
+            notes.append("types with no estimated_bytes had no sample that reported a size and are left out of the total")
+        if estimates.get("ADV_TILESET_GLB", {}).get("to_fetch"):
+            notes.append("tileset textures are listed inside the tileset glbs so they can't be counted until those are downloaded")
+        plan = {"model": pageid, "time": time.strftime("%Y-%m-%d %H:%M:%S"), "types": estimates, "files_to_fetch": sum(est["estimated_files"] for est in estimates.values()), "estimated_bytes": estimatedBytes, "free_disk_bytes": freeBytes, "fits_on_disk": self.fitsOnDisk, "notes": notes}
+        with open(PLAN_FILENAME, "w", encoding="UTF-8") as f:
+            f.write(json.dumps(plan, indent="\t"))
+
+        for type, est in sorted(estimates.items(), key=lambda item: -(item[1]["estimated_bytes"] or 0)):
+            consoleLog(f"Plan {type}: {est['files']} files, {est['on_disk']} on disk, ~{est['estimated_files']} to fetch ~{formatBytes(est['estimated_bytes'])} (from {est['probed']} probes, {est['probed_missing']} missing, {est['probe_errors']} failed)")
+        consoleLog(f"Plan total: ~{plan['files_to_fetch']} files ~{formatBytes(estimatedBytes)} to fetch, {formatBytes(freeBytes)} free on disk{'' if self.fitsOnDisk else ' NOT ENOUGH'}, written to {PLAN_FILENAME}")
+        for note in notes:
+            consoleLog(f"Plan note: {note}")
+
+
+DOWNLOAD_PLAN: DownloadPlan | None = None
+
+
+def formatBytes(size: float | None):
+    if size is None:
+        return "unknown size"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
 def logUrlDownloadFinish(type, localTarget, url, additionalParams, shouldExist, requestID, error=None, altUrlExists=False):
     global PROGRESS
     logLevel = logging.INFO
@@ -623,7 +1857,7 @@ async def downloadAssets(base, base_page_text):
         shouldExist = True
         toDownload.append(AsyncDownloadItem(type, shouldExist, f"{base}{asset}", local_file))
     await AsyncArrayDownload(toDownload)
-    if react_vendor_filename and os.path.exists(react_vendor_filename):
+    if react_vendor_filename and os.path.exists(react_vendor_filename) and not isModifiedFileCurrent(react_vendor_filename):
         reactCont = ""
         with open(react_vendor_filename, "r", encoding="UTF-8") as f:
             reactCont = f.read()
@@ -659,33 +1893,171 @@ class AsyncDownloadItem:
         self.url = url
         self.file = file
         self.key_type = key_type
+        self.error: Exception | None = None  # set by the scheduler if the download failed
+
+
+class DownloadBatch:
+    # a group of submitted items (ie one AsyncArrayDownload call), tracks when all of them have been processed by the workers. Items can keep being submitted until Close is called, completed items are pushed to the completed queue if one is given so a consumer can act on each as it lands.
+    def __init__(self, total: int = 0, completed: asyncio.Queue[AsyncDownloadItem | None] | None = None):
+        self.submitted = 0
+        self.finished = 0
+        self.closed = False
+        self.completed = completed
+        self.done = asyncio.Event()
+        self.progress = tqdm(total=total)
+
+    def ItemAdded(self):
+        self.submitted += 1
+        if self.submitted > self.progress.total:
+            self.progress.total = self.submitted
+            self.progress.refresh()
+
+    def ItemDone(self, asset: AsyncDownloadItem):
+        self.finished += 1
+        self.progress.update(1)
+        if self.completed is not None:
+            self.completed.put_nowait(asset)  # unbounded so a worker never blocks here
+        self._checkDone()
+
+    def Close(self):
+        self.closed = True
+        self._checkDone()
+
+    def _checkDone(self):
+        if self.closed and self.finished >= self.submitted:
+            self.done.set()
+
+    async def Wait(self):
+        await self.done.wait()
+        self.progress.close()
+
+
+class DownloadScheduler:
+    """Fixed pool of worker coroutines pulling AsyncDownloadItems off a bounded queue.  Producers block on put when the queue is full so we never have more than workers + queue size items in flight."""
+
+    def __init__(self, workers: int, queueSize: int):
+        self.workerCount = workers
+        self.queueSize = queueSize
+        self.queue: asyncio.Queue[tuple[AsyncDownloadItem, DownloadBatch]] = None  # type: ignore - created on the running loop in Start
+        self.workers: list[asyncio.Task] = []
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.busy = 0
+        self.peakBusy = 0
+        self.peakQueueDepth = 0
+        self.processed = 0
+        self.busyTimeTotal = 0.0  # integral of busy workers over time, lets us get the average utilization
+        self.lastBusyChange = 0.0
+        self.startTime = 0.0
+
+    def Start(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is loop:
+            return
+        self.loop = loop
+        self.queue = asyncio.Queue(self.queueSize)
+        self.startTime = self.lastBusyChange = time.monotonic()
+        self.workers = [loop.create_task(self._worker()) for _ in range(self.workerCount)]
+
+    async def Shutdown(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.loop = None
+        logging.debug(f"{self}")
+
+    def _busyChange(self, amt: int):
+        now = time.monotonic()
+        self.busyTimeTotal += self.busy * (now - self.lastBusyChange)
+        self.lastBusyChange = now
+        self.busy += amt
+        self.peakBusy = max(self.peakBusy, self.busy)
+
+    async def _worker(self):
+        while True:
+            asset, batch = await self.queue.get()
+            self._busyChange(1)
+            try:
+                await downloadFile(asset.type, asset.shouldExist, asset.url, asset.file, key_type=asset.key_type)
+            except Exception as ex:  # noqa: BLE001
+                asset.error = ex  # downloadFile already logged and counted the failure, one bad item should not stop the worker
+            finally:
+                self._busyChange(-1)
+                self.processed += 1
+                batch.ItemDone(asset)
+                self.queue.task_done()
+
+    def NewBatch(self, total: int = 0, completed: asyncio.Queue[AsyncDownloadItem | None] | None = None):
+        self.Start()
+        return DownloadBatch(total, completed)
+
+    async def Submit(self, asset: AsyncDownloadItem, batch: DownloadBatch):
+        batch.ItemAdded()
+        await self.queue.put((asset, batch))  # blocks when full which gives the producer backpressure
+        self.peakQueueDepth = max(self.peakQueueDepth, self.queue.qsize())
+
+    async def Download(self, assets: list[AsyncDownloadItem]):
+        batch = self.NewBatch(len(assets))
+        for asset in assets:
+            await self.Submit(asset, batch)
+        batch.Close()
+        await batch.Wait()
 
+    def __str__(self):
+        elapsed = max(time.monotonic() - self.startTime, 0.001)
+        avgBusy = (self.busyTimeTotal + self.busy * (time.monotonic() - self.lastBusyChange)) / elapsed
+        depth = self.queue.qsize() if self.queue is not None else 0
+        return f"Scheduler workers: {self.workerCount} busy: {self.busy} peak busy: {self.peakBusy} avg busy: {avgBusy:.1f} ({avgBusy / self.workerCount:.0%}) queue depth: {depth}/{self.queueSize} peak queue depth: {self.peakQueueDepth} processed: {self.processed}"
 
-class ExceptionWhatExceptionTaskGroup(asyncio.TaskGroup):
-    def __init__(self):
-        super().__init__()
-        self._parent_cancel_requested = True  # hacky but required to prevent an aborted task from stopping us from being async
 
-    def _abort(self):  # normally it goes through and cancels all the others now
-        return None
+async def AsyncArrayDownload(assets: list[AsyncDownloadItem]):
+    PROGRESS.RelativeMark()
+    if CLA.getCommandLineArg(CommandLineArg.DOWNLOAD):  # drop already downloaded items up front so they never cost a task
+        toFetch = [asset for asset in assets if not isAlreadyDownloaded(getLocalFile(asset.file))]
+        if DOWNLOAD_PLAN is not None and len(toFetch) != len(assets):
+            fetching = set(map(id, toFetch))
+            for asset in assets:
+                if id(asset) not in fetching:
+                    DOWNLOAD_PLAN.AddOnDisk(asset.type, asset.url, getLocalFile(asset.file))
+        if len(toFetch) != len(assets):
+            PROGRESS.Increment(ProgressType.Skipped, len(assets) - len(toFetch))
+            logging.debug(f"Skipped {len(assets) - len(toFetch)} of {len(assets)} items already downloaded")
+        assets = toFetch
+    await DOWNLOAD_SCHEDULER.Download(assets)
+    logging.debug(f"{PROGRESS}")
+    logging.debug(f"{DOWNLOAD_SCHEDULER}")
 
-    async def __aexit__(self, et, exc, tb):  # at end of block it would throw any exceptions
-        try:
-            await super().__aexit__(et, exc, tb)
-        except:
-            pass
+
+@dataclass
+class DeferredDownload:
+    priority: DownloadPriority
+    description: str
+    cwd: str  # the stage runs from the directory it was deferred in so its relative file paths still work
+    stage: Callable[[], Awaitable[Any]]
 
 
-async def AsyncArrayDownload(assets: list[AsyncDownloadItem]):
-    async with ExceptionWhatExceptionTaskGroup() as tg:
-        PROGRESS.RelativeMark()
+DEFERRED_DOWNLOADS: list[DeferredDownload] = []
 
-        for asset in tqdm(assets):
-            tg.create_task(downloadFile(asset.type, asset.shouldExist, asset.url, asset.file, key_type=asset.key_type))
-            await asyncio.sleep(0.001)  # we need some sleep or we will not yield
-            while MAX_TASKS_SEMAPHORE.locked():
-                await asyncio.sleep(0.01)
-        logging.debug(f"{PROGRESS}")
+
+# Hands lower priority work (higher res tiles, detail meshes, crops, photos) off to downloadDeferred so everything needed to first render the model lands first and an interrupted or still running capture is viewable early
+def deferDownload(priority: DownloadPriority, description: str, stage: Callable[[], Awaitable[Any]]):
+    DEFERRED_DOWNLOADS.append(DeferredDownload(priority, description, os.getcwd(), stage))
+
+
+# Runs the deferred stages highest priority first, ones of the same priority in the order they were deferred.  A stage can defer more work (ie texture crops once the textures are counted).
+async def downloadDeferred():
+    while DEFERRED_DOWNLOADS:
+        deferred = DEFERRED_DOWNLOADS.pop(min(range(len(DEFERRED_DOWNLOADS)), key=lambda i: DEFERRED_DOWNLOADS[i].priority.value))
+        consoleLog(f"Downloading {deferred.description}...")
+        os.chdir(deferred.cwd)
+        try:
+            await deferred.stage()
+        except Exception:
+            logging.exception(f"Deferred download of {deferred.description} had exception of")
+            if CLA.getCommandLineArg(CommandLineArg.DEBUG):
+                raise
+        finally:
+            os.chdir(THIS_MODEL_ROOT_DIR)
 
 
 # can get called twice for defurnished with the second call being the base model id
@@ -760,6 +2132,7 @@ async def downloadPics(pageid):
 async def downloadMainAssets(pageid, accessurl):
     global THIS_MODEL_ROOT_DIR, MODEL_IS_DEFURNISHED
     sweepUUIDs: list[str] = []
+    sweepPlan: dict[str, list[str]] = {}
     if MODEL_IS_DEFURNISHED:  # technically we could use this for all, and this data is in the prefetch embedded as well
         with open("api/mp/models/graph_GetShowcaseSweeps.json", "r", encoding="UTF-8") as f:
             graphModelSweepsJson = json.loads(f.read())
@@ -773,6 +2146,7 @@ async def downloadMainAssets(pageid, accessurl):
             if not CLA.getCommandLineArg(CommandLineArg.TILDE):
                 sweepDir = sweepDir.replace("~", "_")
             accessurl = accessurl + "{filename}?t=2-796d5d010d7183bce7f0999701973d8b05b2df8f-1735673498-0"  # access key here doesnt matter as we will be replacing it
+            sweepPlan = getSweepTilePlan(sweepUUIDs)
             makeDirs(sweepDir)
             os.chdir(sweepDir)
     else:
@@ -789,15 +2163,16 @@ async def downloadMainAssets(pageid, accessurl):
         makeDirs(basePath)
         os.chdir(basePath)
         await downloadDAM(accessurl, modeldata["job"]["uuid"])
-        sweepUUIDs = modeldata["sweeps"]
-    # now: getShowcaseSweeps then need to iterate the locatiosn and get the uuid data.model.locations[0].pano.sweepUuid  this would resolve many of the 404s we will get by just bruteforcing  each location has its only max res (2k 4k etc)
-    await downloadSweeps(accessurl, sweepUUIDs)  # sweeps are generally the biggest thing minus a few modles that have massive 3d detail items
+        sweepPlan = getSweepTilePlan(modeldata["sweeps"])
+    await downloadSweeps(accessurl, sweepPlan)  # sweeps are generally the biggest thing minus a few modles that have massive 3d detail items
     os.chdir(THIS_MODEL_ROOT_DIR)
 
 
 # Patch showcase.js to fix expiration issue
 def patchShowcase():
     global BASE_MATTERPORT_DOMAIN
+    if isModifiedFileCurrent(MAIN_SHOWCASE_FILENAME):
+        return
     with open(MAIN_SHOWCASE_FILENAME, "r", encoding="UTF-8") as f:
         j = f.read()
     j = re.sub(r"\&\&\(!e.expires\|\|.{1,10}\*e.expires>Date.now\(\)\)", "", j)  # old
@@ -843,8 +2218,30 @@ def RemoteDomainsReplace(str: str):
     return str
 
 
+# the showcase version folder on the static host the page's relative urls are from
+def getStaticBase(base_page_text: str) -> str:
+    return re.search(rf'<base href="(https://static.{BASE_MATTERPORT_DOMAIN}/.*?)">', base_page_text).group(1)  # type: ignore - may be None
+
+
+def getBasePageDeunicode(base_page_text: str) -> str:
+    return base_page_text.encode("utf-8", errors="ignore").decode("unicode-escape")  # some non-english matterport pages have unicode escapes for even the generic url chars
+
+
+# the cdn url the model files are under with a {filename} placeholder and the page's default access key, None if the page doesn't have one
+def getAccessUrl(base_page_deunicode: str) -> str | None:
+    match = re.search(r'"(?P<baseurl>https://cdn-\d*\.matterport(?:vr)?\.(?:com|cn)/models/[a-z0-9\-_/.]*/)(?:[{}0-9a-z_/<>.~]+)(?P<defaultAccessKey>\?t=.*?)"', base_page_deunicode)  # the ~/ optional is mostly for defurnished secondary models
+    # matterportvr.cn
+    if match is None:
+        return None
+    groupDict = match.groupdict()
+    return f"{groupDict['baseurl']}~/{{filename}}{groupDict['defaultAccessKey']}"
+
+
 async def downloadCapture(pageid):
-    global PROGRESS, RUN_ARGS_CONFIG_NAME, BASE_MATTERPORT_DOMAIN, CHINA_MATTERPORT_DOMAIN, THIS_MODEL_ROOT_DIR, MODEL_IS_DEFURNISHED, BASE_MODEL_ID
+    global PROGRESS, RUN_ARGS_CONFIG_NAME, BASE_MATTERPORT_DOMAIN, CHINA_MATTERPORT_DOMAIN, THIS_MODEL_ROOT_DIR, MODEL_IS_DEFURNISHED, BASE_MODEL_ID, MANIFEST, FILE_INDEX, ASSET_CACHE, MODIFIED_FILES_REUSABLE
+    assetCacheDir = CLA.getCommandLineArg(CommandLineArg.ASSET_CACHE)
+    if assetCacheDir and ASSET_CACHE is None:  # relative to the base folder, a batch keeps the one cache open for all its models
+        ASSET_CACHE = SharedAssetCache(os.path.abspath(assetCacheDir))
     makeDirs(pageid)
     BASE_MODEL_ID = pageid
     alias = CLA.getCommandLineArg(CommandLineArg.ALIAS)
@@ -857,7 +2254,13 @@ async def downloadCapture(pageid):
         if not os.path.exists(fl):
             shutil.copy2(os.path.join(BASE_MATTERPORTDL_DIR, fl), fl)
 
-    logging.basicConfig(filename="run_report.log", level=logging.DEBUG, format="%(asctime)s %(levelname)-8s %(message)s", datefmt="%Y-%m-%d %H:%M:%S", encoding="utf-8")
+    logging.basicConfig(filename="run_report.log", force=True, level=logging.DEBUG, format="%(asctime)s %(levelname)-8s %(message)s", datefmt="%Y-%m-%d %H:%M:%S", encoding="utf-8")
+    MANIFEST = DownloadManifest(MANIFEST_FILENAME, THIS_MODEL_ROOT_DIR)
+    modifiedFilesSignature = getModifiedFilesSignature()
+    MODIFIED_FILES_REUSABLE = CLA.getCommandLineArg(CommandLineArg.DOWNLOAD) and MANIFEST.GetSetting("modified_files_signature") == modifiedFilesSignature  # a --no-download run is for redoing the post download work
+    indexStart = time.monotonic()
+    FILE_INDEX = LocalFileIndex(THIS_MODEL_ROOT_DIR)
+    logging.debug(f"Indexed {len(FILE_INDEX.files)} existing files in {time.monotonic() - indexStart:.2f}s")
 
     if CLA.getCommandLineArg(CommandLineArg.DEBUG):
         makeDirs("debug")
@@ -892,18 +2295,13 @@ async def downloadCapture(pageid):
             raise TypeError("First request error") from error
 
     KeyHandler.SaveKeysFromText("MainBasePage", base_page_text)
-    staticbase = re.search(rf'<base href="(https://static.{BASE_MATTERPORT_DOMAIN}/.*?)">', base_page_text).group(1)  # type: ignore - may be None
+    staticbase = getStaticBase(base_page_text)
 
-    base_page_deunicode = base_page_text.encode("utf-8", errors="ignore").decode("unicode-escape")  # some non-english matterport pages have unicode escapes for even the generic url chars
+    base_page_deunicode = getBasePageDeunicode(base_page_text)
     if CLA.getCommandLineArg(CommandLineArg.DEBUG):
         DebugSaveFile("base_page_deunicode.html", base_page_deunicode)  # noqa: E701
-    match = re.search(r'"(?P<baseurl>https://cdn-\d*\.matterport(?:vr)?\.(?:com|cn)/models/[a-z0-9\-_/.]*/)(?:[{}0-9a-z_/<>.~]+)(?P<defaultAccessKey>\?t=.*?)"', base_page_deunicode)  # the ~/ optional is mostly for defurnished secondary models
-    # matterportvr.cn
-    if match:
-        groupDict = match.groupdict()
-        accessurl = f"{groupDict['baseurl']}~/{{filename}}{groupDict['defaultAccessKey']}"
-
-    else:
+    accessurl = getAccessUrl(base_page_deunicode)
+    if accessurl is None:
         raise Exception(f"Can't find urls, try the main page: {url} in a browser to make sure it loads the model correctly")
 
     if not MODEL_IS_DEFURNISHED:
@@ -912,27 +2310,32 @@ async def downloadCapture(pageid):
         KeyHandler.SetAccessKey(AccessKeyType.FILES3_TEMPLATE_KEY, KeyHandler.GetKeysFromStr(file_type_content)[0])
 
     consoleLog("Downloading graph model data...")  # need the details one for advanced download
+    sync = CLA.getCommandLineArg(CommandLineArg.SYNC)
+    syncBase = loadSyncBase() if sync else {}  # even when planning so the real sync still has the old graph data to compare to
     await downloadGraphModels(pageid)
+    if sync and DOWNLOAD_PLAN is None:
+        syncModelChanges(syncBase)
+
+    if not isModifiedFileCurrent("index.html"):
+        # Automatic redirect if GET param isn't correct
+        forcedProxyBase = "window.location.origin"
+        # forcedProxyBase='"http://127.0.0.1:9000"'
+        # window._ProxyAppendURL=1;
+        injectedjs = 'if (!window.location.search.startsWith("?m=' + pageid + '")) { document.location.search = "?m=' + pageid + '"; };window._NoTilde=' + ("false" if CLA.getCommandLineArg(CommandLineArg.TILDE) else "true") + ";window._ProxyBase=" + forcedProxyBase + ";"
+        content = base_page_text.replace(staticbase, ".")
+        proxyAdd = ""
+        if CLA.getCommandLineArg(CommandLineArg.MANUAL_HOST_REPLACEMENT):
+            content = RemoteDomainsReplace(content)
+        else:
+            content = re.sub(r"(?P<preDomain>src\s*=\s*['" '"])https?://[^/"' "']+/", r"\g<preDomain>", content, flags=re.IGNORECASE)  # we replace any src= https://whatever.com  stripping the part up to the first slash
+            content = re.sub(r"import\(\s*\s*(?P<quoteChar>['\"])https?://[^/\"']+/", r"import(\g<quoteChar>./", content, flags=re.IGNORECASE)  # similar to above but for import('http://...  must add ./ as well
+            proxyAdd = "<script blocking='render' src='JSNetProxy.js'></script>"
 
-    # Automatic redirect if GET param isn't correct
-    forcedProxyBase = "window.location.origin"
-    # forcedProxyBase='"http://127.0.0.1:9000"'
-    # window._ProxyAppendURL=1;
-    injectedjs = 'if (!window.location.search.startsWith("?m=' + pageid + '")) { document.location.search = "?m=' + pageid + '"; };window._NoTilde=' + ("false" if CLA.getCommandLineArg(CommandLineArg.TILDE) else "true") + ";window._ProxyBase=" + forcedProxyBase + ";"
-    content = base_page_text.replace(staticbase, ".")
-    proxyAdd = ""
-    if CLA.getCommandLineArg(CommandLineArg.MANUAL_HOST_REPLACEMENT):
-        content = RemoteDomainsReplace(content)
-    else:
-        content = re.sub(r"(?P<preDomain>src\s*=\s*['" '"])https?://[^/"' "']+/", r"\g<preDomain>", content, flags=re.IGNORECASE)  # we replace any src= https://whatever.com  stripping the part up to the first slash
-        content = re.sub(r"import\(\s*\s*(?P<quoteChar>['\"])https?://[^/\"']+/", r"import(\g<quoteChar>./", content, flags=re.IGNORECASE)  # similar to above but for import('http://...  must add ./ as well
-        proxyAdd = "<script blocking='render' src='JSNetProxy.js'></script>"
-
-    content = validUntilFix(content)
-    content = content.replace("<head>", f"<head><script>{injectedjs}</script>{proxyAdd}")
-    content = content.replace('from "https://static.matterport.com', 'from ".')  # fix the direct code import they added
-    with open(getModifiedName("index.html"), "w", encoding="UTF-8") as f:
-        f.write(content)
+        content = validUntilFix(content)
+        content = content.replace("<head>", f"<head><script>{injectedjs}</script>{proxyAdd}")
+        content = content.replace('from "https://static.matterport.com', 'from ".')  # fix the direct code import they added
+        with open(getModifiedName("index.html"), "w", encoding="UTF-8") as f:
+            f.write(content)
 
     consoleLog("Downloading model info...")
     await downloadInfo(pageid)
@@ -947,34 +2350,49 @@ async def downloadCapture(pageid):
         await KeyHandler.PrintUrlKeys(urlKeyFind, urlKeyFindIsDownload)
         exit(0)
 
-    consoleLog("Downloading Advanced Assets...")
-    if CLA.getCommandLineArg(CommandLineArg.ADVANCED_DOWNLOAD):
-        await AdvancedAssetDownload(base_page_text)
-
+    KeyHandler.EnableRefresh(pageid)
+    # Everything the viewer needs to first render the model goes first: the showcase files, the dam and the low res sweep tiles.  The phases defer the rest (see deferDownload) which all runs at the end by priority.
     consoleLog("Downloading static files...")
     await downloadAssets(staticbase, base_page_text)
     await downloadWebglVendors(base_page_text)
     # Patch showcase.js to fix expiration issue and some other changes for local hosting
-    patchShowcase()
+    if DOWNLOAD_PLAN is None:
+        patchShowcase()
+        MANIFEST.SetSetting("modified_files_signature", modifiedFilesSignature)  # only once every .modified file is generated so an interrupted run with new settings can't leave stale ones looking current
     consoleLog("Downloading plugins...")
     await downloadPlugins(pageid)
-    if not MODEL_IS_DEFURNISHED:
-        consoleLog("Downloading images...")
-        await downloadPics(pageid)
-    consoleLog("Downloading matterport tags / embedded attachments...")
-    await downloadAttachments()
     open("api/v1/event", "a").close()
+
+    consoleLog("Downloading Advanced Assets...")
+    if CLA.getCommandLineArg(CommandLineArg.ADVANCED_DOWNLOAD):
+        await AdvancedAssetDownload(base_page_text)
     if CLA.getCommandLineArg(CommandLineArg.MAIN_ASSET_DOWNLOAD):
         consoleLog(f"Downloading primary model assets has 4k: {SWEEP_DO_4K}...")
         await downloadMainAssets(pageid, accessurl)
     os.chdir(THIS_MODEL_ROOT_DIR)
+    if not MODEL_IS_DEFURNISHED:
+        deferDownload(DownloadPriority.Extras, "images", partial(downloadPics, pageid))
+    deferDownload(DownloadPriority.Extras, "matterport tags / embedded attachments", downloadAttachments)
+    await downloadDeferred()
+    if DOWNLOAD_PLAN is not None:
+        DOWNLOAD_PLAN.Finish(pageid)
+        return
     generatedCrops = 0
     if CLA.getCommandLineArg(CommandLineArg.GENERATE_TILE_MESH_CROPS):
         consoleLog("Generating tile_mesh crop images locally (no progress shown)...")
         generatedCrops = GenerateMeshImageCrops()
 
+    # this run's graph data is the base for the next sync, also when this was not a --sync run as a base left by an interrupted sync is older than what we just downloaded
+    shutil.rmtree(SYNC_BASE_DIR, ignore_errors=True)
+
     PROGRESS.ClearRelative()
     consoleLog(f"Done, {PROGRESS} GeneratedCrops: {generatedCrops}!")
+    consoleDebugLog(f"{DOWNLOAD_SCHEDULER}")
+    consoleDebugLog(f"{OUR_SESSION}")
+    consoleDebugLog(f"{getTrafficShaper()}")
+    for hostController in HOST_CONTROLLERS.values():
+        consoleDebugLog(f"Adaptive concurrency {hostController}")
+    consoleDebugLog(f"Download manifest totals: {MANIFEST.StatusCounts()}")
 
 
 def GenerateMeshImageCrops():
@@ -1034,6 +2452,108 @@ def GenerateCrops(jpgFilePath):
     return howMany
 
 
+# Reads just the JSON chunk of a binary glTF (GLB) and returns the relative image uris (the lod*_*.jpg|ktx2 textures) it references.  Layout is a 12 byte header (magic, version, total length) then chunks of (length, type, data) with the JSON chunk always first, so we never read the BIN chunk that makes up most of the file.  Only the small JSON chunk is read so it runs on a worker thread rather than needing a process pool.
+def getGlbImageUris(glbFile: str) -> list[str]:
+    with open(glbFile, "rb") as f:
+        header = memoryview(f.read(GLB_HEADER_SIZE + GLB_CHUNK_HEADER_SIZE))
+        if len(header) < GLB_HEADER_SIZE + GLB_CHUNK_HEADER_SIZE:
+            raise Exception(f"File too small to be a glb: {glbFile}")
+        magic, version, _ = struct.unpack_from("<III", header, 0)
+        chunkLength, chunkType = struct.unpack_from("<II", header, GLB_HEADER_SIZE)
+        if magic != GLB_MAGIC or chunkType != GLB_CHUNK_TYPE_JSON:
+            raise Exception(f"Not a glb with a leading JSON chunk (magic: {magic:#x} version: {version} first chunk: {chunkType:#x}): {glbFile}")
+        gltf = json.loads(f.read(chunkLength))
+    uris: list[str] = []
+    for image in gltf.get("images", []):
+        uri = image.get("uri")
+        if uri and not uri.startswith("data:") and "://" not in uri and uri not in uris:
+            uris.append(uri)
+    return uris
+
+
+# Walks a 3D Tiles tileset document (root tile, children, content/contents) yielding each tile's content uri as it is found.  JSON that isn't a tileset just has any "uri" values found anywhere in it yielded so the per depth files are still handled structurally.
+def walkTileset(doc: Any) -> Iterator[str]:
+    if isinstance(doc, dict) and isinstance(doc.get("root"), dict):
+        tiles: list[dict] = [doc["root"]]
+        while tiles:
+            tile = tiles.pop()
+            contents = list(tile.get("contents") or [])
+            if isinstance(tile.get("content"), dict):
+                contents.insert(0, tile["content"])
+            for content in contents:
+                uri = content.get("uri") or content.get("url")  # url is the pre 1.0 name
+                if uri:
+                    yield uri
+            tiles.extend(reversed(tile.get("children") or []))
+        return
+
+    stack: list[Any] = [doc]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            if isinstance(node.get("uri"), str):
+                yield node["uri"]
+            stack.extend(child for child in reversed(list(node.values())) if isinstance(child, (dict, list)))
+        elif isinstance(node, list):
+            stack.extend(child for child in reversed(node) if isinstance(child, (dict, list)))
+
+
+# Fetches the tileset GLBs through the scheduler and as each one lands pulls the texture references out of it, queuing those textures straight away rather than after the whole crawl
+async def crawlTilesetGLBs(tilesetUrlTemplate: str, uris: Iterable[str]):
+    glbsDone: asyncio.Queue[AsyncDownloadItem | None] = asyncio.Queue()
+    glbBatch = DOWNLOAD_SCHEDULER.NewBatch(completed=glbsDone)
+    textureBatch = DOWNLOAD_SCHEDULER.NewBatch()
+    glbUris: dict[str, str] = {}
+
+    async def queueTextures():
+        seen: set[str] = set()
+        while (glb := await glbsDone.get()) is not None:
+            glbFile = getLocalFile(glb.file)
+            if glb.error is not None or not os.path.exists(glbFile):
+                continue
+            try:
+                chunks = await asyncio.to_thread(getGlbImageUris, glbFile)
+                chunks.sort()
+                uri = glbUris[glb.file]
+                for ktx2 in chunks:
+                    chunkUri = f"{uri[:2]}{ktx2}"
+                    if chunkUri in seen:
+                        continue
+                    seen.add(chunkUri)
+                    chunkUrl = tilesetUrlTemplate.replace("<file>", chunkUri)
+                    await DOWNLOAD_SCHEDULER.Submit(AsyncDownloadItem("ADV_TILESET_TEXTURE", False, chunkUrl, urlparse(chunkUrl).path[1:], key_type=AccessKeyType.LeaveKeyAlone), textureBatch)
+            except Exception:
+                logging.exception(f"Unable to extract textures from tileset glb: {glbFile}")
+
+    consumer = asyncio.create_task(queueTextures())
+    for uri in uris:
+        url = tilesetUrlTemplate.replace("<file>", uri)
+        glb = AsyncDownloadItem("ADV_TILESET_GLB", False, url, urlparse(url).path[1:], key_type=AccessKeyType.LeaveKeyAlone)
+        if glb.file in glbUris:
+            continue
+        glbUris[glb.file] = uri
+        await DOWNLOAD_SCHEDULER.Submit(glb, glbBatch)
+    glbBatch.Close()
+    await glbBatch.Wait()
+    glbsDone.put_nowait(None)
+    await consumer
+    textureBatch.Close()
+    await textureBatch.Wait()
+    consoleDebugLog(f"Tileset crawl fetched {len(glbUris)} glbs and {textureBatch.submitted} textures, {DOWNLOAD_SCHEDULER}")
+
+
+# the model data json the main page embeds for the client, None if we can't find it
+def getPrefetchedModelData(base_page_text: str) -> Any:
+    match = re.search(r"window.MP_PREFETCHED_MODELDATA = (\{.+?\}\}\});", base_page_text)
+    if match:
+        return json.loads(match.group(1))
+    match = re.search(r"window.MP_PREFETCHED_MODELDATA = parseJSON\((\"\{.+?\}\}\}\")\);", base_page_text)  # this happens for extra unicode encoded pages
+    consoleDebugLog("Main page embedded preset data was unicode/parseJSON passed instead of normal")
+    if match:
+        return json.loads(json.loads(match.group(1)))  # yes we load it twice, it is a string passed to parseJson so the first load just unescapes that string
+    return None
+
+
 async def AdvancedAssetDownload(base_page_text: str):
     global MODEL_IS_DEFURNISHED, BASE_MODEL_ID, SWEEP_DO_4K
     ADV_CROP_FETCH = [{"start": "width=512&crop=1024,1024,", "increment": "0.5"}, {"start": "crop=512,512,", "increment": "0.25"}]
@@ -1063,21 +2583,11 @@ async def AdvancedAssetDownload(base_page_text: str):
         except Exception:
             logging.exception("Unable to open graph model for snapshots output json something probably wrong.....")
 
-        match = re.search(r"window.MP_PREFETCHED_MODELDATA = (\{.+?\}\}\});", base_page_text)
-        preload_json_str = None
-        if not match:
-            match = re.search(r"window.MP_PREFETCHED_MODELDATA = parseJSON\((\"\{.+?\}\}\}\")\);", base_page_text)  # this happens for extra unicode encoded pages
-            consoleDebugLog("Main page embedded preset data was unicode/parseJSON passed instead of normal")
-            if not match:
-                logging.exception("Unable to open graph model for snapshots output json something probably wrong.....")
-                consoleLog("###### UNABLE to extract pre-fetch data from main page, will try to proceed but likely have issues", logging.WARNING)
-            else:
-                preload_json_str = json.loads(match.group(1))  # yes we load it here first, it is a string passed to parseJson so this basically unescapes that string into preload_json_str which will then be loaded again later
+        preload_json = getPrefetchedModelData(base_page_text)  # in theory this json should be similar to GetModelDetails, sometimes it is a bit different so we may want to switch
+        if preload_json is None:
+            logging.exception("Unable to open graph model for snapshots output json something probably wrong.....")
+            consoleLog("###### UNABLE to extract pre-fetch data from main page, will try to proceed but likely have issues", logging.WARNING)
         else:
-            preload_json_str = match.group(1)
-
-        if preload_json_str is not None:
-            preload_json = json.loads(preload_json_str)  # in theory this json should be similar to GetModelDetails, sometimes it is a bit different so we may want to switch
             base_cache_node = preload_json["queries"]["GetModelPrefetch"]["data"]["model"]
         if CLA.getCommandLineArg(CommandLineArg.DEBUG):
             DebugSaveFile("base_page_extracted_json.json", json.dumps(preload_json, indent="\t"))  # noqa: E701
@@ -1124,15 +2634,18 @@ async def AdvancedAssetDownload(base_page_text: str):
         # the photos and skyboxes similar urls (including working keys) can be found on the api/v1/player/models/ID/index.html file but note the V1 versions .url is not with the access key but .src is
 
         # now: instead from the snapshots graph data: data.model.assets.photos
+        photosToDownload: list[AsyncDownloadItem] = []
         for photo in base_node_snapshots["assets"]["photos"]:
             imageUrl = photo["url"]  # this should be uncropped and unscaled original
             if not imageUrl:
                 imageUrl = photo["presentationUrl"]  # fallback not sure we every need this
-            toDownload.append(AsyncDownloadItem("ADV_MODEL_IMAGES", True, imageUrl, urlparse(imageUrl).path[1:], key_type=AccessKeyType.LeaveKeyAlone))
+            photosToDownload.append(AsyncDownloadItem("ADV_MODEL_IMAGES", True, imageUrl, urlparse(imageUrl).path[1:], key_type=AccessKeyType.LeaveKeyAlone))
+        deferDownload(DownloadPriority.Extras, "model photos", partial(AsyncArrayDownload, photosToDownload))
 
         # Download GetModelPrefetch.data.model.locations[X].pano.skyboxes[Y].urlTemplate
         # now: getsweeps graph data: data.model.locations
         resolutionDetectionWarning = ""
+        higherSkyboxes: dict[str, list[AsyncDownloadItem]] = {res: [] for res in SWEEP_TILE_PRIORITY}  # deferred with the sweep tiles of the same resolution
         do4K = len(base_node["locations"]) == 0  # by default only do 4k if we have no locations data to check
         for location in base_node["locations"]:
             if "4k" in location["pano"]["resolutions"]:
@@ -1151,80 +2664,77 @@ async def AdvancedAssetDownload(base_page_text: str):
                 try:
                     for face in range(6):
                         skyboxUrlTemplate = skybox["urlTemplate"].replace("<face>", f"{face}")
-                        toDownload.append(AsyncDownloadItem("ADV_SKYBOX", False, skyboxUrlTemplate, urlparse(skyboxUrlTemplate).path[1:], key_type=AccessKeyType.LeaveKeyAlone))
+                        higherSkyboxes.get(skybox["resolution"], toDownload).append(AsyncDownloadItem("ADV_SKYBOX", False, skyboxUrlTemplate, urlparse(skyboxUrlTemplate).path[1:], key_type=AccessKeyType.LeaveKeyAlone))
                 except:
                     pass
+        for res, skyboxes in higherSkyboxes.items():
+            if skyboxes:
+                deferDownload(SWEEP_TILE_PRIORITY[res], f"{res} skyboxes", partial(AsyncArrayDownload, skyboxes))
         SWEEP_DO_4K = do4K
         if resolutionDetectionWarning:
             consoleDebugLog(resolutionDetectionWarning)
-        consoleLog("Going to download tileset 3d asset models")
-        # Download Tilesets
-        # now: getmodeldetails: data.model.assets.tilesets
-        for tileset in base_cache_node["assets"]["tilesets"]:  # normally just one tileset
-            tilesetUrl = tileset["url"]
-            tilesetDepth = int(tileset["tilesetDepth"])
-            tilesetUrlTemplate: str = tileset["urlTemplate"]
-            if "<file>" not in tilesetUrlTemplate:  # the graph details does have it but the cached data does not
-                tilesetUrlTemplate = tilesetUrlTemplate.replace("?", "<file>?")
-            tilesetBaseFile = urlparse(tilesetUrl).path[1:]
-            try:
-                tileSetBytes = await downloadFileAndGetText("ADV_TILESET", False, tilesetUrl, tilesetBaseFile, isBinary=True, key_type=AccessKeyType.LeaveKeyAlone)
-                tileSetText = tileSetBytes.decode("utf-8", "ignore")
-                # tileSetText = validUntilFix(tileSetText)
-                # with open(getModifiedName(tilesetBaseFile), "w", encoding="UTF-8") as f:
-                # f.write(tileSetText)
-
-                uris = re.findall(r'"uri":"(.+?)"', tileSetText)  # a bit brutish to extract rather than just walking the json
-
-                uris.sort()
-
-                for uri in tqdm(uris):
-                    url = tilesetUrlTemplate.replace("<file>", uri)
-                    try:
-                        chunkBytes = await downloadFileAndGetText("ADV_TILESET_GLB", False, url, urlparse(url).path[1:], isBinary=True, key_type=AccessKeyType.LeaveKeyAlone)
-                        chunkText = chunkBytes.decode("utf-8", "ignore")
-                        chunks = re.findall(r"(lod[0-9]_[a-zA-Z0-9-_]+\.(jpg|ktx2))", chunkText)
-                        # print("Found chunks: ",chunks)
-                        chunks.sort()
-                        for ktx2 in chunks:
-                            chunkUri = f"{uri[:2]}{ktx2[0]}"
-                            chunkUrl = tilesetUrlTemplate.replace("<file>", chunkUri)
-                            toDownload.append(AsyncDownloadItem("ADV_TILESET_TEXTURE", False, chunkUrl, urlparse(chunkUrl).path[1:], key_type=AccessKeyType.LeaveKeyAlone))
-
-                    except:
-                        raise
-            except:
-                raise
+        await AsyncArrayDownload(toDownload)
 
-            for file in range(tilesetDepth + 1):
+        # tileset 3d asset models and the full textures only add detail over the 50k dam so they wait for the first render assets
+        async def downloadMeshDetail():
+            texturesToDownload: list[AsyncDownloadItem] = []
+            croppedToDownload: list[AsyncDownloadItem] = []
+            # Download Tilesets
+            # now: getmodeldetails: data.model.assets.tilesets
+            for tileset in base_cache_node["assets"]["tilesets"]:  # normally just one tileset
+                tilesetUrl = tileset["url"]
+                tilesetDepth = int(tileset["tilesetDepth"])
+                tilesetUrlTemplate: str = tileset["urlTemplate"]
+                if "<file>" not in tilesetUrlTemplate:  # the graph details does have it but the cached data does not
+                    tilesetUrlTemplate = tilesetUrlTemplate.replace("?", "<file>?")
+                tilesetBaseFile = urlparse(tilesetUrl).path[1:]
                 try:
-                    tileseUrlTemplate = tilesetUrlTemplate.replace("<file>", f"{file}.json")
-                    getFileText = await downloadFileAndGetText("ADV_TILESET_JSON", False, tileseUrlTemplate, urlparse(tileseUrlTemplate).path[1:], key_type=AccessKeyType.LeaveKeyAlone)
-                    fileUris = re.findall(r'"uri":"(.*?)"', getFileText)
-                    fileUris.sort()
-                    for fileuri in fileUris:
-                        fileUrl = tilesetUrlTemplate.replace("<file>", fileuri)
-                        try:
-                            toDownload.append(AsyncDownloadItem("ADV_TILESET_EXTRACT", False, fileUrl, urlparse(fileUrl).path[1:], key_type=AccessKeyType.LeaveKeyAlone))
-                        except:
-                            pass
-
-                except:
-                    pass
-
-        # now: getmodeldetails: data.model.assets.textures
-        for texture in base_node["assets"]["textures"]:
-            try:  # on first exception assume we have all the ones needed so cant use array download as need to know which fails (other than for crops)
-                for i in range(1000):
-                    full_text_url = texture["urlTemplate"].replace("<texture>", f"{i:03d}")
+                    tileSetBytes = await downloadFileAndGetText("ADV_TILESET", False, tilesetUrl, tilesetBaseFile, isBinary=True, key_type=AccessKeyType.LeaveKeyAlone)
+                    tilesetDoc = json.loads(tileSetBytes) if tileSetBytes else None
+                except Exception:  # like a bad depth file this only costs us the glbs, the depth files and full textures still go ahead
+                    logging.exception(f"Unable to read tileset {tilesetBaseFile}, skipping its glbs")
+                    tilesetDoc = None
+                if tilesetDoc is not None:
+                    await crawlTilesetGLBs(tilesetUrlTemplate, walkTileset(tilesetDoc))
+
+                # the per depth json files go out concurrently and whatever they reference is queued as each one is walked
+                extractBatch = DOWNLOAD_SCHEDULER.NewBatch()
+
+                async def crawlDepthFile(depthFile: str, tilesetUrlTemplate: str, extractBatch: DownloadBatch):
+                    depthUrl = tilesetUrlTemplate.replace("<file>", depthFile)
+                    getFileText = await downloadFileAndGetText("ADV_TILESET_JSON", False, depthUrl, urlparse(depthUrl).path[1:], key_type=AccessKeyType.LeaveKeyAlone)
+                    if not getFileText:
+                        return
+                    for uri in walkTileset(json.loads(getFileText)):
+                        fileUrl = tilesetUrlTemplate.replace("<file>", uri)
+                        await DOWNLOAD_SCHEDULER.Submit(AsyncDownloadItem("ADV_TILESET_EXTRACT", False, fileUrl, urlparse(fileUrl).path[1:], key_type=AccessKeyType.LeaveKeyAlone), extractBatch)
+
+                depthResults = await asyncio.gather(*(crawlDepthFile(f"{depth}.json", tilesetUrlTemplate, extractBatch) for depth in range(tilesetDepth + 1)), return_exceptions=True)
+                for depth, result in enumerate(depthResults):
+                    if isinstance(result, Exception):
+                        if "Error 404" in f"{result}":  # missing depth files are expected
+                            logging.debug(f"Tileset depth file {depth}.json is missing")
+                        else:
+                            logging.warning(f"Tileset depth file {depth}.json failed: {result}")
+                extractBatch.Close()
+                await extractBatch.Wait()
+
+            # now: getmodeldetails: data.model.assets.textures
+            def fullTextureUrl(texture, i: int) -> str:
+                return texture["urlTemplate"].replace("<texture>", f"{i:03d}")
+
+            async def discoverTextureCount(texture) -> int:
+                return await discoverSeriesCount(lambda i: downloadFile("ADV_TEXTURE_FULL", False, fullTextureUrl(texture, i), urlparse(fullTextureUrl(texture, i)).path[1:]))
+
+            textureCounts = await asyncio.gather(*(discoverTextureCount(texture) for texture in base_node["assets"]["textures"]))
+            for texture, textureCount in zip(base_node["assets"]["textures"], textureCounts):
+                consoleDebugLog(f"Found {textureCount} {texture['quality']} quality textures")
+                for i in range(textureCount):
+                    full_text_url = fullTextureUrl(texture, i)
+                    texturesToDownload.append(AsyncDownloadItem("ADV_TEXTURE_FULL", True, full_text_url, urlparse(full_text_url).path[1:]))  # already fetched while counting, will just be skipped
                     crop_to_do = []
                     if texture["quality"] == "high":
                         crop_to_do = ADV_CROP_FETCH
-
-                    try:  # try our full texture first so we can bail out before trying each and every crop
-                        await downloadFile("ADV_TEXTURE_FULL", True, full_text_url, urlparse(full_text_url).path[1:])
-                    except:
-                        break
                     for crop in crop_to_do:
                         for x in list(drange(0, 1, decimal.Decimal(crop["increment"]))):
                             for y in list(drange(0, 1, decimal.Decimal(crop["increment"]))):
@@ -1236,12 +2746,11 @@ async def AdvancedAssetDownload(base_page_text: str):
                                     ys = ys[:-2]
                                 complete_add = f"{crop['start']}x{xs},y{ys}"
                                 complete_add_file = complete_add.replace("&", "_")
-                                toDownload.append(AsyncDownloadItem("ADV_TEXTURE_CROPPED", False, full_text_url + "&" + complete_add, urlparse(full_text_url).path[1:] + complete_add_file + ".jpg"))  # failures here ok we dont know all teh crops that exist, so we can still use the array downloader
+                                croppedToDownload.append(AsyncDownloadItem("ADV_TEXTURE_CROPPED", False, full_text_url + "&" + complete_add, urlparse(full_text_url).path[1:] + complete_add_file + ".jpg"))  # failures here ok we dont know all teh crops that exist, so we can still use the array downloader
+            await AsyncArrayDownload(texturesToDownload)
+            deferDownload(DownloadPriority.Extras, "texture crops", partial(AsyncArrayDownload, croppedToDownload))
 
-            except Exception:
-                logging.exception("Adv download texture have exception")
-        consoleLog("Downloading textures and previews for tileset 3d models")
-        await AsyncArrayDownload(toDownload)
+        deferDownload(DownloadPriority.MeshDetail, "tileset 3d asset models and textures", downloadMeshDetail)
     except Exception:
         logging.exception("Adv download general had exception of")
         if CLA.getCommandLineArg(CommandLineArg.DEBUG):
@@ -1251,15 +2760,114 @@ async def AdvancedAssetDownload(base_page_text: str):
     # KeyHandler.EnableDisableKeyReplacement(True)
 
 
+# --plan just plans the capture, --preflight plans it first and only goes on to download it if the disk has room
+async def planAndDownloadCapture(pageid):
+    global DOWNLOAD_PLAN
+    planOnly = CLA.getCommandLineArg(CommandLineArg.PLAN)
+    if not planOnly and not CLA.getCommandLineArg(CommandLineArg.PREFLIGHT):
+        await downloadCapture(pageid)
+        return
+    startDir = os.getcwd()
+    plan = DOWNLOAD_PLAN = DownloadPlan()
+    try:
+        await downloadCapture(pageid)
+    finally:
+        DOWNLOAD_PLAN = None
+    if planOnly:
+        return
+    if not plan.fitsOnDisk:
+        raise Exception(f"Not enough free disk space to download {pageid}, see {PLAN_FILENAME} in the model folder")
+    await finishCapture()
+    os.chdir(startDir)
+    resetCaptureState()
+    getPageId(pageid)  # the reset cleared MODEL_IS_DEFURNISHED, BASE_MATTERPORT_DOMAIN is worked out again from the main page
+    await downloadCapture(pageid)
+
+
 async def initiateDownload(url):
     try:
         async with OUR_SESSION:
-            await downloadCapture(getPageId(url))
+            try:
+                await planAndDownloadCapture(getPageId(url))
+            finally:
+                await finishCapture()
+                closeAssetCache()
     except Exception:
         logging.exception("Unhandled fatal exception")
         raise
 
 
+# Downloads each model in turn in this one process and event loop.  Concurrent captures are not supported (see TODO.md): a capture works out of its model folder (os.chdir) and module/KeyHandler globals so only one can be in progress at a time.  The session pool, scheduler, adaptive concurrency and traffic shaping state carry over so later models start on warm connections and the global limits hold across the whole batch.  A model failing is logged and the batch moves on, returns the ids that failed.
+async def initiateBatchDownload(pageIds: list[str]) -> list[str]:
+    batchDir = os.getcwd()
+    cliValues = CLA.GetValues()
+    failed: list[str] = []
+    async with OUR_SESSION:
+        try:
+            for i, pageId in enumerate(pageIds):
+                consoleLog(f"Batch download {i + 1} of {len(pageIds)}: {pageId}")
+                os.chdir(batchDir)
+                resetCaptureState()
+                getPageId(pageId)  # the reset cleared MODEL_IS_DEFURNISHED, getPageId sets it again for this model
+                CLA.SetValues(cliValues)  # each model gets its own run_args.json on top of the batch's command line like a separate run would
+                existingConfigFile = os.path.join(pageId, RUN_ARGS_CONFIG_NAME)
+                if os.path.exists(existingConfigFile):
+                    try:
+                        CLA.LoadFromFile(existingConfigFile)
+                        CLA.parseArgs()
+                    except:
+                        logging.exception(f"Unable to load {existingConfigFile}, using the batch's command line for {pageId}")
+                try:
+                    await planAndDownloadCapture(pageId)
+                except Exception:
+                    logging.exception(f"Batch download of {pageId} failed")
+                    consoleLog(f"Download of {pageId} failed, see its run_report.log, continuing with the rest of the batch", logging.ERROR)
+                    failed.append(pageId)
+                finally:
+                    await finishCapture()
+        finally:
+            closeAssetCache()
+            os.chdir(batchDir)
+    failedStr = f", failed: {' '.join(failed)}" if failed else ""
+    consoleLog(f"Batch done, {len(pageIds) - len(failed)} of {len(pageIds)} models downloaded{failedStr}")
+    return failed
+
+
+# per capture cleanup, the scheduler is restarted by the next capture so anything a failed capture left queued is dropped rather than written into the next model's folder
+async def finishCapture():
+    KeyHandler.StopRefresh()
+    await DOWNLOAD_SCHEDULER.Shutdown()
+    if MANIFEST is not None:
+        MANIFEST.Close()
+
+
+# module state a capture fills in, reset so each model of a batch starts like a fresh process would
+def resetCaptureState():
+    global dirsMadeCache, SWEEP_DO_4K, MODEL_IS_DEFURNISHED, BASE_MODEL_ID, BASE_MATTERPORT_DOMAIN, MAIN_SHOWCASE_FILENAME, PROGRESS, MANIFEST, FILE_INDEX, MODIFIED_FILES_REUSABLE
+    dirsMadeCache = {}
+    SWEEP_DO_4K = True
+    MODEL_IS_DEFURNISHED = False
+    BASE_MODEL_ID = ""
+    BASE_MATTERPORT_DOMAIN = "matterport.com"
+    MAIN_SHOWCASE_FILENAME = ""
+    PROGRESS = ProgressStats()
+    MANIFEST = None
+    FILE_INDEX = None
+    MODIFIED_FILES_REUSABLE = False
+    DEFERRED_DOWNLOADS.clear()
+    KeyHandler.Reset()
+
+
+# --batch takes model ids/urls separated by commas or whitespace, or a file of them one per line (# comments allowed)
+def getBatchPageIds(batch: str) -> list[str]:
+    if os.path.isfile(batch):
+        with open(batch, "r", encoding="UTF-8") as f:
+            entries = [line.split("#")[0].strip() for line in f]
+    else:
+        entries = re.split(r"[\s,]+", batch)
+    return list(dict.fromkeys(getPageId(entry) for entry in entries if entry))
+
+
 def getPageId(url):
     global MODEL_IS_DEFURNISHED
     id = url.split("m=")[-1].split("&")[0]
@@ -1269,6 +2877,100 @@ def getPageId(url):
     return id
 
 
+class LazyFetcher:
+    """Read through for --lazy-serve: files the viewer asks for that are missing from the download are fetched upstream with the model's keys and saved into the model folder before they are served, so a model published with only part of its files fills in from real viewer traffic.  Our session, key routing and key refresh are all asyncio so the fetches run on an event loop in a background thread that the server's request threads block on.  Concurrent requests for the same missing file share the one fetch.  The model's download manifest is used so files the download (or an earlier lazy fetch) found missing upstream are answered with a 404 straight away rather than asked for again on every viewer request."""
+
+    def __init__(self, pageId: str):
+        self.pageId = pageId
+        self.staticBase = ""
+        self.cdnBase = ""
+        self.inflight: dict[str, asyncio.Task[bool]] = {}  # only touched on the loop thread
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="LazyFetcher", daemon=True).start()
+        self._loadModel()
+        asyncio.run_coroutine_threadsafe(self._openManifest(), self.loop).result()
+        asyncio.run_coroutine_threadsafe(refreshAccessKeys(pageId, "lazy serving needs current keys"), self.loop).result()  # the keys we downloaded have likely expired
+        KeyHandler.EnableRefresh(pageId)
+
+    # the upstream hosts come from the main page and the keys from the key bearing files we downloaded
+    def _loadModel(self):
+        global BASE_MATTERPORT_DOMAIN
+        if not os.path.exists("index.html"):
+            raise Exception("--lazy-serve needs at least the main page (index.html) of the model downloaded")
+        with open("index.html", "r", encoding="UTF-8") as f:
+            base_page_text = f.read()
+        if f"{CHINA_MATTERPORT_DOMAIN}/showcase" in base_page_text:
+            BASE_MATTERPORT_DOMAIN = CHINA_MATTERPORT_DOMAIN
+        self.staticBase = getStaticBase(base_page_text)
+        accessurl = getAccessUrl(getBasePageDeunicode(base_page_text))
+        if accessurl is not None:
+            parsed = urlparse(accessurl)
+            self.cdnBase = f"{parsed.scheme}://{parsed.netloc}/"
+        KeyHandler.SaveKeysFromText("MainBasePage", base_page_text)
+        for i in range(1, 4):
+            filesFile = f"api/player/models/{self.pageId}/files_type{i}"
+            if not os.path.exists(filesFile):
+                continue
+            with open(filesFile, "r", encoding="UTF-8") as f:
+                fileText = f.read()
+            KeyHandler.SaveKeysFromText(f"FilesType{i}", fileText)
+            if i == 3 and KeyHandler.GetKeysFromStr(fileText):
+                KeyHandler.SetAccessKey(AccessKeyType.FILES3_TEMPLATE_KEY, KeyHandler.GetKeysFromStr(fileText)[0])
+
+    # on the loop thread as that is the only thread that downloads and sqlite connections are tied to the thread that opened them
+    async def _openManifest(self):
+        global MANIFEST
+        MANIFEST = DownloadManifest(MANIFEST_FILENAME, os.path.abspath("."))
+
+    # urls to try for a file path relative to the model folder, the download mirrors each host's url paths: model files from the cdn, api from my. and the rest from the static host (mostly the showcase version folder)
+    def GetUpstreamUrls(self, path: str) -> list[str]:
+        path = "/".join("~" if segment == "_" else segment for segment in path.split("/"))  # without --tilde the ~ path segments were saved as _
+        if path.startswith("models/"):
+            if not self.cdnBase:
+                return []
+            url = self.cdnBase + path
+            if KeyHandler.PrimaryKey:
+                url = KeyHandler.SetAccessKeyForUrl(url, KeyHandler.PrimaryKey, addIfMissing=True)
+            return [url]
+        if path.startswith("api/"):
+            return [f"https://my.{BASE_MATTERPORT_DOMAIN}/{path}"]
+        return [self.staticBase + path, f"https://static.{BASE_MATTERPORT_DOMAIN}/{path}"]
+
+    async def _download(self, path: str) -> bool:
+        if MANIFEST is not None and not CLA.getCommandLineArg(CommandLineArg.RETRY_MISSING) and MANIFEST.IsKnownMissing(path):
+            logging.debug(f"Lazy serve not fetching {path}, known missing in the download manifest")
+            return False
+        try:
+            for url in self.GetUpstreamUrls(path):
+                keyType = AccessKeyType.PrimaryKey if KeyHandler.RE_ACCESS_KEY_EXTRACT.search(url) else AccessKeyType.LeaveKeyAlone
+                try:
+                    await downloadFile("LAZY_SERVE", False, url, path, always_download=True, key_type=keyType)  # always_download as we checked known missing for the path above and a 404 from the first host must not stop us trying the next
+                    return True
+                except Exception:  # noqa: BLE001, S112
+                    continue  # downloadFile logged it, try the next host
+            return False
+        finally:
+            if MANIFEST is not None:
+                MANIFEST.Commit()  # the server is usually stopped with ctrl+c so nothing would get to Close it
+
+    async def _fetch(self, path: str) -> bool:
+        if path not in self.inflight:
+            self.inflight[path] = asyncio.create_task(self._download(path))
+            self.inflight[path].add_done_callback(lambda _: self.inflight.pop(path, None))
+        return await asyncio.shield(self.inflight[path])  # one waiter giving up must not cancel the fetch for the others
+
+    # called from the server's request threads, blocks until path is on disk or we know it can't be fetched
+    def Fetch(self, path: str) -> bool:
+        try:
+            return asyncio.run_coroutine_threadsafe(self._fetch(path), self.loop).result(LAZY_SERVE_TIMEOUT)
+        except Exception:
+            logging.exception(f"Lazy serve fetch of {path} failed")
+            return False
+
+
+LAZY_FETCHER: LazyFetcher | None = None
+
+
 class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
     def send_error(self, code, message=None, explain=None):
         if code == 404:
@@ -1364,6 +3066,11 @@ class OurSimpleHTTPRequestHandler(SimpleHTTPRequestHandler):
 
         if redirect_msg is not None or orig_request != self.path:
             consoleDebugLog(f"Redirecting {orig_request} => {self.path} as {redirect_msg}", loglevel=logging.INFO)
+        localFile = self.translate_path(self.path)  # also what drops any .. from the path
+        if LAZY_FETCHER is not None and not os.path.exists(localFile):
+            lazyPath = os.path.relpath(localFile).replace(os.path.sep, "/")
+            if LAZY_FETCHER.Fetch(lazyPath):
+                consoleDebugLog(f"Lazy serve fetched missing {lazyPath} from upstream", loglevel=logging.INFO)
         SimpleHTTPRequestHandler.do_GET(self)
 
     def isPotentialModifiedFile(self):
@@ -1433,14 +3140,19 @@ GRAPH_DATA_REQ = {
     "GetFloors": "?operationName=GetFloors&variables=%7B%22modelId%22%3A%22[MATTERPORT_MODEL_ID]%22%7D&extensions=%7B%22persistedQuery%22%3A%7B%22version%22%3A1%2C%22sha256Hash%22%3A%225df6b8c235ad84bba1032135922354e8850320ce8780315993722778d9835f15%22%7D%7D",
     "GetModelOptions": "?operationName=GetModelOptions&variables=%7B%22modelId%22%3A%22[MATTERPORT_MODEL_ID]%22%7D&extensions=%7B%22persistedQuery%22%3A%7B%22version%22%3A1%2C%22sha256Hash%22%3A%2248765f4d53c1700521382c03034c1b67e63b9bdc6cccdc6c4e853620cd9c74c7%22%7D%7D",
 }
-OUR_SESSION: requests.AsyncSession
+OUR_SESSION: HostSessionPool
 MAX_TASKS_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+GLB_MAGIC = 0x46546C67  # b"glTF" little endian
+GLB_CHUNK_TYPE_JSON = 0x4E4F534A  # b"JSON" little endian
+GLB_HEADER_SIZE = 12
+GLB_CHUNK_HEADER_SIZE = 8
+DOWNLOAD_SCHEDULER = DownloadScheduler(MAX_CONCURRENT_TASKS, MAX_QUEUED_DOWNLOADS)
 RUN_ARGS_CONFIG_NAME = "run_args.json"
 
 
 def SetupSession(use_proxy):
     global OUR_SESSION, MAX_CONCURRENT_REQUESTS, BASE_MATTERPORT_DOMAIN
-    OUR_SESSION = requests.AsyncSession(impersonate="chrome", max_clients=MAX_CONCURRENT_REQUESTS, verify=CLA.getCommandLineArg(CommandLineArg.VERIFY_SSL), proxies=({"http": use_proxy, "https": use_proxy} if use_proxy else None), headers={"Referer": f"https://my.{BASE_MATTERPORT_DOMAIN}/", "x-matterport-application-name": "showcase"})
+    OUR_SESSION = HostSessionPool(impersonate="chrome", verify=CLA.getCommandLineArg(CommandLineArg.VERIFY_SSL), proxies=({"http": use_proxy, "https": use_proxy} if use_proxy else None), headers={"Referer": f"https://my.{BASE_MATTERPORT_DOMAIN}/", "x-matterport-application-name": "showcase"})
 
 
 def RegisterWindowsBrowsers():
@@ -1475,7 +3187,7 @@ def RegisterWindowsBrowsers():
 
 
 def startServer(baseDir, pageId, browserLaunch, bindAddress, bindPort):
-    global SERVED_BASE_URL
+    global SERVED_BASE_URL, LAZY_FETCHER
     twinDir = getPageId(pageId)
     if not os.path.exists(twinDir):
         fullPath = os.path.abspath(twinDir)
@@ -1497,7 +3209,12 @@ def startServer(baseDir, pageId, browserLaunch, bindAddress, bindPort):
     logging.info(f"Server starting up {sys_info()}")
     SERVED_BASE_URL = url = f"http://{bindAddress}:{bindPort}"
     print("View in browser: " + url)
-    httpd = HTTPServer((bindAddress, bindPort), OurSimpleHTTPRequestHandler)
+    if CLA.getCommandLineArg(CommandLineArg.LAZY_SERVE):
+        consoleLog("Lazy serving, files missing from the download will be fetched as they are requested")
+        LAZY_FETCHER = LazyFetcher(os.path.basename(os.path.realpath(".")))  # the folder name is the model id even when served by alias
+        httpd = ThreadingHTTPServer((bindAddress, bindPort), OurSimpleHTTPRequestHandler)  # so one slow fetch does not hold up every other request
+    else:
+        httpd = HTTPServer((bindAddress, bindPort), OurSimpleHTTPRequestHandler)
     if browserLaunch:
         print(f"Going to try and launch browser type: {browserLaunch}")
         import webbrowser
@@ -1520,6 +3237,17 @@ class KeyHandler:
     KNOWN_ACCESS_KEYS: ClassVar[dict[str, str]] = {}  # key to source(s) of key
     # most resources work with our main page generic key but the dam file uses the dam key
     ACCESS_KEYS_BY_TYPE: ClassVar[dict[AccessKeyType, str]] = {}
+    # learned by downloadWithKeyRouting, url pattern (see GetKeyRoutePattern) to the key that last worked for it
+    KEY_ROUTES: ClassVar[dict[str, str]] = {}
+    KEY_ROUTE_CANARIES: ClassVar[dict[str, asyncio.Event]] = {}  # patterns with a canary request in flight, set once it is done
+    KEY_ROUTE_EXHAUSTED: ClassVar[set[str]] = set()  # patterns the canary found no working key for
+    KEY_ROUTE_REJECTED: ClassVar[dict[str, set[str]]] = {}  # pattern to keys that got a 403 for it
+    KEY_SUCCESSES: ClassVar[dict[str, int]] = {}
+    # background refresh of the typed keys, off until EnableRefresh is called once the initial keys are in
+    RefreshModelId: ClassVar[str] = ""
+    RefreshTask: ClassVar[asyncio.Task | None] = None
+    LastRefresh: ClassVar[float] = 0.0  # when the typed keys were last fetched, this is the key age we go by as the timestamp in a key is not its expiry
+    FailuresSinceRefresh: ClassVar[int] = 0
 
     @staticmethod
     def GetAllKeys() -> list[str]:
@@ -1534,12 +3262,97 @@ class KeyHandler:
         if type(key) is not str or not key:
             raise Exception(f"Call with invalid key for SetAccessKey {key_type} = {key}")
         consoleDebugLog(f"SetAccessKey for {key_type} = {key}")
+        oldKey = KeyHandler.ACCESS_KEYS_BY_TYPE.get(key_type)
         KeyHandler.ACCESS_KEYS_BY_TYPE[key_type] = key
+        if oldKey and oldKey != key:  # a refreshed key takes over wherever the old one was working
+            if KeyHandler.PrimaryKey == oldKey:
+                KeyHandler.PrimaryKey = key
+            for pattern, routeKey in KeyHandler.KEY_ROUTES.items():
+                if routeKey == oldKey:
+                    KeyHandler.KEY_ROUTES[pattern] = key
         if key_type == AccessKeyType.MAIN_PAGE_GENERIC_KEY:
             KeyHandler.PrimaryKey = key
         if KeyHandler.PrimaryKey is None and key_type == AccessKeyType.FILES3_TEMPLATE_KEY:  # our former primary key
             KeyHandler.PrimaryKey = key
 
+    @staticmethod
+    def GetKeyRoutePattern(url: str) -> str:
+        parsed = urlparse(url)
+        dirs = ["*" if RE_KEY_ROUTE_ID_SEGMENT.fullmatch(segment) else segment for segment in parsed.path.split("/")[:-1]]
+        return f"{parsed.hostname}{'/'.join(dirs)}/*{os.path.splitext(parsed.path)[1]}"
+
+    # keys to try for url best first: the learned route, the key url already has, the typed keys, then everything else we have seen by how often it has worked.  Keys that got a 403 for this pattern go last.
+    @staticmethod
+    def GetRankedKeys(pattern: str, url: str, maxKeys: int) -> list[str]:
+        existing = KeyHandler.GetKeysFromStr(url)
+        if pattern in KeyHandler.KEY_ROUTE_EXHAUSTED:
+            return existing[:1] or [KeyHandler.KEY_ROUTES[pattern]]
+        candidates = [KeyHandler.KEY_ROUTES.get(pattern), *existing, KeyHandler.PrimaryKey, *KeyHandler.ACCESS_KEYS_BY_TYPE.values()]
+        candidates += sorted(KeyHandler.KNOWN_ACCESS_KEYS, key=lambda key: -KeyHandler.KEY_SUCCESSES.get(key, 0))
+        rejected = KeyHandler.KEY_ROUTE_REJECTED.get(pattern, set())
+        ranked = list(dict.fromkeys(key for key in candidates if key and key not in rejected))
+        ranked += [key for key in rejected if key in existing]  # still worth one try if it is all we have
+        return ranked[:maxKeys]
+
+    @staticmethod
+    def RecordKeyResult(pattern: str, key: str, worked: bool):
+        if worked:
+            KeyHandler.KEY_SUCCESSES[key] = KeyHandler.KEY_SUCCESSES.get(key, 0) + 1
+            KeyHandler.KEY_ROUTE_REJECTED.get(pattern, set()).discard(key)
+            if KeyHandler.KEY_ROUTES.get(pattern) != key:
+                logging.info(f"Access key route {pattern} => {key}")
+                KeyHandler.KEY_ROUTES[pattern] = key
+        else:
+            KeyHandler.KEY_ROUTE_REJECTED.setdefault(pattern, set()).add(key)
+            if key in KeyHandler.ACCESS_KEYS_BY_TYPE.values():
+                KeyHandler.FailuresSinceRefresh += 1
+
+    # a new capture in the same process (batch mode) starts knowing no keys
+    @staticmethod
+    def Reset():
+        KeyHandler.StopRefresh()
+        KeyHandler.PrimaryKey = None
+        KeyHandler.KNOWN_ACCESS_KEYS = {}
+        KeyHandler.ACCESS_KEYS_BY_TYPE = {}
+        KeyHandler.KEY_ROUTES = {}
+        KeyHandler.KEY_ROUTE_CANARIES = {}
+        KeyHandler.KEY_ROUTE_EXHAUSTED = set()
+        KeyHandler.KEY_ROUTE_REJECTED = {}
+        KeyHandler.KEY_SUCCESSES = {}
+        KeyHandler.LastRefresh = 0.0
+        KeyHandler.FailuresSinceRefresh = 0
+
+    @staticmethod
+    def EnableRefresh(modelId: str):
+        KeyHandler.RefreshModelId = modelId
+        KeyHandler.LastRefresh = time.monotonic()
+        KeyHandler.FailuresSinceRefresh = 0
+
+    @staticmethod
+    def StopRefresh():
+        KeyHandler.RefreshModelId = ""
+        if KeyHandler.RefreshTask is not None:
+            KeyHandler.RefreshTask.cancel()
+            KeyHandler.RefreshTask = None
+
+    # cheap enough to call per request, starts a background refresh once the typed keys are KEY_REFRESH_INTERVAL old or KEY_REFRESH_FAILURES of them have been rejected
+    @staticmethod
+    def CheckRefresh():
+        if not KeyHandler.RefreshModelId or (KeyHandler.RefreshTask is not None and not KeyHandler.RefreshTask.done()):
+            return
+        age = time.monotonic() - KeyHandler.LastRefresh
+        if age < KEY_REFRESH_MIN_INTERVAL:
+            return
+        if KeyHandler.FailuresSinceRefresh >= KEY_REFRESH_FAILURES:
+            reason = f"{KeyHandler.FailuresSinceRefresh} requests got a 403 with our keys"
+        elif age >= KEY_REFRESH_INTERVAL:
+            reason = f"keys are {age / 60:.0f} minutes old"
+        else:
+            return
+        KeyHandler.LastRefresh = time.monotonic()
+        KeyHandler.FailuresSinceRefresh = 0
+        KeyHandler.RefreshTask = asyncio.create_task(refreshAccessKeys(KeyHandler.RefreshModelId, reason))
+
     @staticmethod
     def GetKeysFromStr(parseText) -> list[str]:
         return KeyHandler.RE_ACCESS_KEY_EXTRACT.findall(parseText)
@@ -1569,41 +3382,59 @@ class KeyHandler:
         toSort.sort()
         DebugSaveFile("keys.txt", "\n".join(toSort))
 
+    # every key we know best candidates first: the key the url already has, learned routes for its pattern, our typed keys, then keys by how many sources we saw them in and newest first
+    @staticmethod
+    def RankKeysForUrl(url: str) -> list[str]:
+        existing = KeyHandler.GetKeysFromStr(url)
+        routed = KeyHandler.KEY_ROUTES.get(KeyHandler.GetKeyRoutePattern(url))
+        typed = set(KeyHandler.ACCESS_KEYS_BY_TYPE.values())
+
+        def score(key: str):
+            return (key not in existing, key != routed, key not in typed, -KeyHandler.KEY_SUCCESSES.get(key, 0), -len(KeyHandler.KNOWN_ACCESS_KEYS.get(key, "").split()), -int(key.split("-")[2]))
+
+        return sorted(dict.fromkeys([*existing, *KeyHandler.KNOWN_ACCESS_KEYS]), key=score)
+
+    # Probes url with every ranked key using a one byte Range request whose body is dropped after the first chunk, so a key costs a few hundred bytes even if the server ignores the Range.  Unless exhaustive, outstanding probes are cancelled once KEY_SEARCH_ENOUGH_KEYS keys work.
+    @staticmethod
+    async def FindUrlKeys(url: str, exhaustive: bool) -> tuple[list[str], int]:
+        candidates = KeyHandler.RankKeysForUrl(url)
+        working: list[str] = []
+        probed = 0
+        pending = iter(candidates)
+        workers: list[asyncio.Task] = []
+
+        async def worker():
+            nonlocal probed
+            for key in pending:
+                probed += 1
+                if await probeUrlWorks(KeyHandler.SetAccessKeyForUrl(url, key)):
+                    working.append(key)
+                    if not exhaustive and len(working) >= KEY_SEARCH_ENOUGH_KEYS:
+                        for task in workers:
+                            if task is not asyncio.current_task():
+                                task.cancel()
+                        return
+
+        workers.extend(asyncio.create_task(worker()) for _ in range(min(MAX_CONCURRENT_REQUESTS, len(candidates))))
+        await asyncio.gather(*workers, return_exceptions=True)
+        working.sort(key=candidates.index)
+        return working, probed
+
     # print all keys that work for url
     @staticmethod
     async def PrintUrlKeys(url, isDownload):
-        # turnKeyReplacementBackOn=False
-        workingKeys = ""
-        # if KeyHandler.KEY_REPLACE_ACTIVE:
-        # KeyHandler.EnableDisableKeyReplacement(False)
-        # turnKeyReplacementBackOn=True
-        # toDownload.append(AsyncDownloadItem(type, shouldExist, f"{base}{asset}", local_file))
         consoleLog("Finding url keys....")
-        toDownload: list[AsyncDownloadItem] = []
-        existingKey = KeyHandler.GetKeysFromStr(url)
-        if len(existingKey) > 0:
-            KeyHandler.KNOWN_ACCESS_KEYS["ORIG"] = existingKey[0]
-        async with aiofiles.tempfile.TemporaryDirectory() as tmp:
-            print(f"Directory is: {tmp}")
-            pathlib.Path(os.path.join(tmp, "test")).touch()
-            haveSavedDownload = False
+        exhaustive = CLA.getCommandLineArg(CommandLineArg.FIND_URL_KEY_EXHAUSTIVE)
+        searchStart = time.monotonic()
+        working, probed = await KeyHandler.FindUrlKeys(url, exhaustive)
+        workingKeys = ""
+        for key in working:
+            workingKeys += f"\t{key}({KeyHandler.KNOWN_ACCESS_KEYS.get(key, ' from url ').strip()})\n"
+        if isDownload and working:
             debugTargetName = os.path.join("debug", os.path.basename(urlparse(url).path[1:]))
-            for key in KeyHandler.KNOWN_ACCESS_KEYS:
-                toDownload.append(AsyncDownloadItem("FindUrlKey", False, KeyHandler.SetAccessKeyForUrl(url, key), os.path.join(tmp, "test_" + key), key_type=AccessKeyType.LeaveKeyAlone))
-            await AsyncArrayDownload(toDownload)
-            for _file in os.listdir(tmp):
-                if not _file.startswith("test_"):
-                    continue
-                if isDownload:
-                    if not haveSavedDownload:
-                        haveSavedDownload = True
-                        shutil.copy(os.path.join(tmp, _file), debugTargetName)
-                file = _file[5:]
-                workingKeys += f"\t{file}({KeyHandler.KNOWN_ACCESS_KEYS[file].strip()})\n"
-
-        # if turnKeyReplacementBackOn:
-        # EnableDisableKeyReplacement(True)
-        consoleLog(f"### FOR URL: {url} ACCESS KEYS THAT WORK:\n{workingKeys}")
+            await downloadFile("FindUrlKey", True, KeyHandler.SetAccessKeyForUrl(url, working[0]), debugTargetName, always_download=True, key_type=AccessKeyType.LeaveKeyAlone)
+        searchType = "all keys" if exhaustive else f"stopping at {KEY_SEARCH_ENOUGH_KEYS} working"
+        consoleLog(f"### FOR URL: {url} ACCESS KEYS THAT WORK ({probed} of {len(KeyHandler.RankKeysForUrl(url))} keys probed in {time.monotonic() - searchStart:.1f}s, {searchType}):\n{workingKeys}")
 
     @staticmethod
     def SetAccessKeyForUrl(url: str, key_val: str, addIfMissing=False):
@@ -1619,7 +3450,7 @@ class KeyHandler:
         return url.replace(match.group(0), key_val)
 
 
-CommandLineArg = Enum("CommandLineArg", ["ADVANCED_DOWNLOAD", "PROXY", "VERIFY_SSL", "DEBUG", "CONSOLE_LOG", "TILDE", "BASE_FOLDER", "ALIAS", "DOWNLOAD", "MAIN_ASSET_DOWNLOAD", "MANUAL_HOST_REPLACEMENT", "ALWAYS_DOWNLOAD_GRAPH_REQS", "QUIET", "HELP", "ADV_HELP", "AUTO_SERVE", "FIND_URL_KEY", "FIND_URL_KEY_AND_DOWNLOAD", "REFRESH_KEY_FILES", "GENERATE_TILE_MESH_CROPS", "TITLE"])
+CommandLineArg = Enum("CommandLineArg", ["ADVANCED_DOWNLOAD", "PROXY", "VERIFY_SSL", "DEBUG", "CONSOLE_LOG", "TILDE", "BASE_FOLDER", "ALIAS", "DOWNLOAD", "MAIN_ASSET_DOWNLOAD", "MANUAL_HOST_REPLACEMENT", "ALWAYS_DOWNLOAD_GRAPH_REQS", "QUIET", "HELP", "ADV_HELP", "AUTO_SERVE", "FIND_URL_KEY", "FIND_URL_KEY_AND_DOWNLOAD", "REFRESH_KEY_FILES", "GENERATE_TILE_MESH_CROPS", "TITLE", "STREAM_CHUNK_SIZE", "RETRY_MISSING", "ADAPTIVE_CONCURRENCY", "MAX_BANDWIDTH", "MAX_HOST_BANDWIDTH", "MAX_REQUEST_RATE", "MAX_HOST_REQUEST_RATE", "FIND_URL_KEY_EXHAUSTIVE", "BATCH", "ASSET_CACHE", "SYNC", "SYNC_PRUNE", "PLAN", "PREFLIGHT", "LAZY_SERVE"])
 ArgAppliesTo = Enum("ArgAppliesTo", ["DOWNLOAD", "SERVING", "BOTH"])
 
 
@@ -1725,6 +3556,15 @@ class CLA:
         CLA.value_cache[arg] = cla.currentValue
         return cla.currentValue
 
+    @staticmethod
+    def GetValues() -> dict[CommandLineArg, Any]:
+        return {cla.arg: cla.currentValue for cla in CLA.all_args}
+
+    @staticmethod
+    def SetValues(values: dict[CommandLineArg, Any]):
+        for arg, value in values.items():
+            CLA.setCommandLineArg(arg, value)
+
     @staticmethod
     def setCommandLineArg(arg: CommandLineArg, value: Any):
         CLA.value_cache.pop(arg, None)  # Clear cache entry if exists
@@ -1745,6 +3585,17 @@ def main():
     CLA.addCommandLineArg(CommandLineArg.ADVANCED_DOWNLOAD, "downloading advanced assets enables things like skyboxes, dollhouse, floorplan layouts, now primary access keys come from it so generally required", True)
     CLA.addCommandLineArg(CommandLineArg.DEBUG, "debug mode enables select debug output to console or the debug/ folder mostly for developers", False, allow_saved=False)
     CLA.addCommandLineArg(CommandLineArg.CONSOLE_LOG, "showing all log messages in the console rather than just the log file, very spammy", False, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.BATCH, "download several models in this one process sharing connections and limits, model ids/urls separated by commas or a file with one per line.  The models are downloaded one at a time, concurrent captures are not supported (see TODO.md) so run separate processes to download models in parallel", "", "ids_or_file", allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.ASSET_CACHE, "folder to share static showcase files (js, css, fonts, images, webgl vendors) between models, they are hardlinked in rather than downloaded again, relative paths are from the base folder", "", "dir", allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.PLAN, "planning the download without doing it, only the model metadata is fetched then the files it would download are counted by type with their size estimated from a few probes of each, saved as download_plan.json in the model folder", False, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.PREFLIGHT, "planning the download first like --plan and only starting it if there is enough free disk space for the estimate", False, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.SYNC, "updating an existing download with what changed in the model since the last run, its graph data is compared to find added, changed and removed assets and only those are fetched, see sync_report.json in the model folder", False, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.SYNC_PRUNE, "deleting the files of assets a --sync found removed or replaced rather than just listing them in sync_report.json", False, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.RETRY_MISSING, "requesting files a previous run of this model found missing (404) rather than skipping them", False, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.MAX_BANDWIDTH, "limit on total download bytes per second across all hosts, 0 for no limit", 0, "bytes/sec")
+    CLA.addCommandLineArg(CommandLineArg.MAX_HOST_BANDWIDTH, "limit on download bytes per second from any one host, 0 for no limit", 0, "bytes/sec")
+    CLA.addCommandLineArg(CommandLineArg.MAX_REQUEST_RATE, "limit on requests started per second across all hosts, 0 for no limit", 0, "requests/sec")
+    CLA.addCommandLineArg(CommandLineArg.MAX_HOST_REQUEST_RATE, "limit on requests started per second to any one host, 0 for no limit", 0, "requests/sec")
 
     CLA.addCommandLineArg(CommandLineArg.DOWNLOAD, "Download items (without this it just does post download actions)", True, hidden=True, allow_saved=False)
     CLA.addCommandLineArg(CommandLineArg.VERIFY_SSL, "SSL verification, mostly useful for proxy situations", True, allow_saved=False, hidden=True)
@@ -1752,12 +3603,17 @@ def main():
     CLA.addCommandLineArg(CommandLineArg.ALWAYS_DOWNLOAD_GRAPH_REQS, "Always download/make graphql requests, a good idea as they have important keys, note if REFRESH_KEY_FILES is off it will still prevent graph files from downloading", True, hidden=True, allow_saved=False)
     CLA.addCommandLineArg(CommandLineArg.FIND_URL_KEY, "A URL to try to find the access key for, makes a few minimal requests upfront to get needed keys", "", "https://my.matterport.com/api/player/models/EGxFGTFyC9N/test.file", hidden=True, allow_saved=False)
     CLA.addCommandLineArg(CommandLineArg.FIND_URL_KEY_AND_DOWNLOAD, "Like FIND_URL_KEY but saves a copy to the debug folder of the item", "", "https://my.matterport.com/api/player/models/EGxFGTFyC9N/test.file", hidden=True, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.FIND_URL_KEY_EXHAUSTIVE, "With FIND_URL_KEY probe every known key rather than stopping once a few work", False, hidden=True, allow_saved=False)
     CLA.addCommandLineArg(CommandLineArg.REFRESH_KEY_FILES, "There are about a half dozen files always downloaded as they may contain access keys we need, this prevents these from downloading", True, hidden=True, allow_saved=False)
     CLA.addCommandLineArg(CommandLineArg.GENERATE_TILE_MESH_CROPS, "Certain views like dollhouse require cropped versions of certain textures, this uses python to generate all those", True, hidden=False, allow_saved=True)
 
+    CLA.addCommandLineArg(CommandLineArg.ADAPTIVE_CONCURRENCY, "Adjusting the in-flight request limit per host based on latency and errors, when disabled each host stays at the starting limit", True, hidden=True, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.STREAM_CHUNK_SIZE, "Bytes to buffer per request before writing to disk while streaming downloads, 0 buffers each whole response in memory", 1024 * 1024, "bytes", hidden=True, allow_saved=False)
+
     CLA.addCommandLineArg(CommandLineArg.MANUAL_HOST_REPLACEMENT, "Use old style replacement of matterport URLs rather than the JS proxy, this likely only works if hosted on port 8080 after", False, hidden=True)
 
     CLA.addCommandLineArg(CommandLineArg.QUIET, "Only show failure log message items when serving", False, applies_to=ArgAppliesTo.SERVING, allow_saved=False)
+    CLA.addCommandLineArg(CommandLineArg.LAZY_SERVE, "fetching files missing from the download from matterport when the viewer asks for them, they are saved into the model folder so a partial download fills in as it is viewed", False, applies_to=ArgAppliesTo.SERVING, allow_saved=False)
     CLA.addCommandLineArg(CommandLineArg.AUTO_SERVE, "Used to automatically start the server hosting a specific file, see README for details", "", "page_id_or_alias|host|port|what-browser", applies_to=ArgAppliesTo.SERVING, hidden=True)
 
     CLA.addCommandLineArg(CommandLineArg.HELP, "", False, hidden=True, allow_saved=False)
@@ -1787,6 +3643,9 @@ def main():
     argPos = 1
     isServerRun = False
     isDownloadRun = False
+    batchPageIds: list[str] = []
+    if CLA.getCommandLineArg(CommandLineArg.BATCH):
+        batchPageIds = getBatchPageIds(CLA.getCommandLineArg(CommandLineArg.BATCH))  # before we change to the base folder as a file is relative to where we were run
     subProcessArgs = CLA.orig_args.copy()  # args we give the interactive UI minus ip and port as it only uses them for downloads
     if len(sys.argv) > argPos:
         pageIdOrIp = sys.argv[argPos]
@@ -1807,21 +3666,25 @@ def main():
             argPos += 1
             bindPort = int(bindPort)
 
+    if batchPageIds and isDownloadRun:  # a model given the normal way just joins the batch
+        batchPageIds = list(dict.fromkeys([pageId, *batchPageIds]))
+        isDownloadRun = False
+
     if not os.path.exists(os.path.join(baseDir, pageId)) and os.path.exists(pageId) and isServerRun:  # allow old rooted pages to still be served
         baseDir = "./"
-    elif isServerRun or isDownloadRun:
+    elif isServerRun or isDownloadRun or batchPageIds:
         makeDirs(baseDir)
         os.chdir(baseDir)
 
     existingConfigFile = os.path.join(pageId, RUN_ARGS_CONFIG_NAME)
-    if os.path.exists(existingConfigFile):
+    if os.path.exists(existingConfigFile) and not batchPageIds:  # batch runs load each model's own as they get to it
         try:
             CLA.LoadFromFile(existingConfigFile)
             CLA.parseArgs()
         except:
             pass
     isExplicitHelpCLI = CLA.getCommandLineArg(CommandLineArg.HELP) or CLA.getCommandLineArg(CommandLineArg.ADV_HELP)
-    if isExplicitHelpCLI or (not isServerRun and not isDownloadRun):
+    if isExplicitHelpCLI or (not isServerRun and not isDownloadRun and not batchPageIds):
         consoleLog(sys_info())
         if not isExplicitHelpCLI and sys.stdin.isatty():
             try:
@@ -1850,6 +3713,9 @@ def main():
     if isDownloadRun:
         asyncio.run(initiateDownload(pageId))
 
+    if batchPageIds and not isServerRun and asyncio.run(initiateBatchDownload(batchPageIds)):
+        sys.exit(1)
+
     if isServerRun:
         startServer(baseDir, pageId, browserLaunch, bindIp, bindPort)
 